@@ -7,25 +7,63 @@ from fastapi.staticfiles import StaticFiles
 from typing import List, Optional, Dict, Any, Union, Tuple
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import SQLAlchemyError
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse, Response
+from fastapi import Request
 import logging
-import sympy
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi import UploadFile, File
-from jscon2pdf import json_to_docx
+from jscon2pdf import json_to_docx, json_to_pdf
 import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
 os.makedirs("output_docs", exist_ok=True)
 
 # Импортируем функции и модели
 from converter import ast2latex
-from index import compare_formulas_sympy  # Предполагается, что compare_formulas_sympy возвращает расширенные данные
+from search import find_similar, formula_to_dict, normalize_latex
+from catalogue_cache import (
+    CatalogueCache,
+    catalogue_etag,
+    choose_encoding,
+    compress,
+    dumps,
+    encoded_etag,
+    etag_matches,
+)
+from coalesce import RequestCoalescer
+from clustering import start_background_job, is_job_running, load_progress, load_result
+from streaming import stream_similar, format_sse, format_ndjson, SSE_MEDIA_TYPE, NDJSON_MEDIA_TYPE
+from sharding import get_shard_urls, scatter_gather
+from scheduler import AdmissionController, AdmissionMiddleware, RequestClass
+from profiling import ProfilingMiddleware, list_profiles, get_profile_path, token_matches, PROFILE_HEADER
+from render import (
+    get_renderer,
+    render_key,
+    RENDER_FORMATS,
+    DEFAULT_FONT_SIZE,
+    DEFAULT_DPI,
+    MIN_FONT_SIZE,
+    MAX_FONT_SIZE,
+    MIN_DPI,
+    MAX_DPI,
+    MAX_LATEX_LENGTH,
+)
+from snapshot import get_snapshot_store, record_change
+from changefeed import get_broker
 from db import (
     create_formula,
     update_formula,
     delete_formula,
-    get_all_formulas,
-    get_db
+    get_catalogue_version,
+    get_formula_latex,
+    get_formulas_page,
+    get_formulas_by_ids,
+    iter_formula_sources,
+    iter_formulas_for_export,
+    get_db,
+    engine,
+    SessionLocal
 )
 
 # Настройка логирования
@@ -38,6 +76,83 @@ app = FastAPI(
     version="1.0.0"
 )
 
+# Пул потоков для тяжёлых вычислений асинхронных эндпоинтов
+SEARCH_EXECUTOR_WORKERS = int(os.environ.get("SEARCH_EXECUTOR_WORKERS", os.cpu_count() or 4))
+search_executor = ThreadPoolExecutor(max_workers=SEARCH_EXECUTOR_WORKERS, thread_name_prefix="search")
+search_coalescer = RequestCoalescer(search_executor)
+# Готовые тела ответов /formulas по версии каталога
+catalogue_cache = CatalogueCache()
+
+
+
+def _apply_catalogue_change(change):
+    """
+    Обновляет структуры поиска процесса по событию ленты изменений (см. changefeed.py):
+    запись, сделанная любым воркером, сразу накладывается на снапшот этого воркера.
+    """
+    # Кеш страниц /formulas и так сверяет версию каталога; очистка лишь освобождает память
+    catalogue_cache.clear()
+    store = get_snapshot_store()
+    # При resync снапшот не сбрасывается: store.get сверяет LaTeX с таблицей,
+    # поэтому пропущенное изменение не приводит к неверному результату
+    if store is None or change["op"] == "resync":
+        return
+    latex_formula = change.get("latex")
+    if change["op"] == "upsert" and latex_formula is None:
+        db = SessionLocal()
+        try:
+            latex_formula = get_formula_latex(db, change["id"])
+        finally:
+            db.close()
+        if latex_formula is None:
+            return
+    store.apply_change(change["op"], change["id"], latex_formula)
+
+
+@app.on_event("startup")
+def start_changefeed():
+    broker = get_broker(engine)
+    broker.subscribe(_apply_catalogue_change)
+    broker.start()
+
+
+@app.on_event("shutdown")
+def stop_changefeed():
+    get_broker(engine).stop()
+    get_renderer().shutdown()
+
+
+# Контроль допуска: у каждого класса эндпоинтов свой лимит одновременных запросов и своя очередь,
+# поэтому всплеск поиска или экспорта не занимает весь пул потоков и не тормозит редактирование
+# (настройки переопределяются переменными SCHEDULER_<КЛАСС>_CONCURRENCY/_QUEUE/_TIMEOUT)
+admission_controller = AdmissionController(
+    classes=[
+        RequestClass.from_env("interactive", concurrency=16, max_queue=256, queue_timeout=5.0),
+        RequestClass.from_env("search", concurrency=os.cpu_count() or 4, max_queue=64, queue_timeout=30.0),
+        RequestClass.from_env("export", concurrency=2, max_queue=16, queue_timeout=60.0),
+    ],
+    routes={
+        "/formulas": "interactive",
+        "/manage_formula": "interactive",
+        "/convert_ast_to_latex": "interactive",
+        "/render": "interactive",
+        "/find_similar": "search",
+        "/find_similar_async": "search",
+        "/find_similar_stream": "search",
+        "/find_similar_sharded": "search",
+        "/convert_to_docx": "export",
+        "/export_docx": "export",
+        "/export_pdf": "export",
+    },
+)
+app.add_middleware(AdmissionMiddleware, controller=admission_controller)
+
+# Профилирование запросов: по заголовку X-Profile с токеном PROFILE_TOKEN
+# или случайной доле запросов PROFILE_SAMPLE_RATE (см. profiling.py)
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN") or None
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", 0) or 0)
+app.add_middleware(ProfilingMiddleware, token=PROFILE_TOKEN, sample_rate=PROFILE_SAMPLE_RATE)
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["http://localhost:3000", "http://127.0.0.1:3000"],
@@ -110,6 +225,26 @@ class DetailedSimilarityInfo(BaseModel):
     common_subexpressions: List[CommonSubexpressionInfo]
 
 
+class ClusteringRequest(BaseModel):
+    restart: bool = False
+    cosine_threshold: float = 0.8
+    similarity_threshold: float = 90.0
+
+
+class ShardedFindSimilarRequest(BaseModel):
+    formula: str
+    top_k: int = 10
+    deadline: Optional[float] = None  # Секунды ожидания ответа шардов
+
+
+class ShardedSimilarityResponse(BaseModel):
+    results: List[DetailedSimilarityInfo]
+    shards_total: int
+    shards_answered: int
+    shards_failed: List[str]
+    shards_timed_out: List[str]
+    partial: bool
+
 
 @app.post("/convert_ast_to_latex", response_model=LatexResponse)
 def convert_ast_to_latex_endpoint(request: ASTToLatexRequest):
@@ -122,6 +257,7 @@ def convert_ast_to_latex_endpoint(request: ASTToLatexRequest):
         raise HTTPException(status_code=400, detail=f"Ошибка при конвертации AST в LaTeX: {e}")
 
 OUTPUT_DIRECTORY = "output_docs"
+CLUSTER_CHECKPOINT_DIR = os.environ.get("CLUSTER_CHECKPOINT_DIR", "cluster_job")
 
 app.mount("/output_docs", StaticFiles(directory=OUTPUT_DIRECTORY), name="output_docs")
 
@@ -148,6 +284,52 @@ def convert_to_docx_endpoint(data: List[FormulaData]):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+class ExportRequest(BaseModel):
+    ids: Optional[List[int]] = None   # ID формул в нужном порядке
+    author_id: Optional[int] = None   # Фильтр по автору (если ids не заданы)
+    query: Optional[str] = None       # Подстрока в LaTeX, легенде или описании (если ids не заданы)
+
+
+@app.post("/export_docx")
+def export_docx_endpoint(request: ExportRequest, db: Session = Depends(get_db)):
+    """
+    Создаёт DOCX из формул каталога по списку ID или фильтру и возвращает ссылку на файл.
+    В отличие от /convert_to_docx, данные формул читаются из базы на сервере.
+    """
+    if request.ids is not None and (request.author_id is not None or request.query):
+        raise HTTPException(status_code=400, detail="Укажите либо ids, либо фильтр (author_id, query).")
+    try:
+        formulas = iter_formulas_for_export(db, ids=request.ids, author_id=request.author_id, query=request.query)
+        file_path = json_to_docx(formulas, OUTPUT_DIRECTORY)
+
+        file_name = os.path.basename(file_path)
+        file_url = f"http://localhost:8000/output_docs/{file_name}"
+        logger.info(f"Файл успешно создан: {file_url}")
+        return {"status": "success", "file_url": file_url}
+    except Exception as e:
+        logger.error(f"Ошибка при создании DOCX: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/export_pdf")
+def export_pdf_endpoint(request: ExportRequest, db: Session = Depends(get_db)):
+    """
+    Создаёт PDF с векторными формулами из формул каталога по списку ID или фильтру
+    и возвращает ссылку на файл.
+    """
+    if request.ids is not None and (request.author_id is not None or request.query):
+        raise HTTPException(status_code=400, detail="Укажите либо ids, либо фильтр (author_id, query).")
+    try:
+        formulas = iter_formulas_for_export(db, ids=request.ids, author_id=request.author_id, query=request.query)
+        file_path = json_to_pdf(formulas, OUTPUT_DIRECTORY)
+
+        file_name = os.path.basename(file_path)
+        file_url = f"http://localhost:8000/output_docs/{file_name}"
+        logger.info(f"Файл успешно создан: {file_url}")
+        return {"status": "success", "file_url": file_url}
+    except Exception as e:
+        logger.error(f"Ошибка при создании PDF: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.post("/manage_formula")
@@ -171,6 +353,7 @@ def manage_formula(latex_formula: LatexFormula, db: Session = Depends(get_db)):
                 description=description
             )
             print(new_formula)
+            record_change("upsert", new_formula.id, new_formula.latex_formula)
             return {"status": "success", "message": "Формула создана.", "formula_id": new_formula.id}
         except SQLAlchemyError as e:
             logger.error(f"Ошибка при создании формулы: {e}")
@@ -188,6 +371,7 @@ def manage_formula(latex_formula: LatexFormula, db: Session = Depends(get_db)):
             updated_formula = update_formula(db, formula_id, **update_data)
             if not updated_formula:
                 raise HTTPException(status_code=404, detail="Формула не найдена.")
+            record_change("upsert", formula_id, updated_formula.latex_formula)
             return {"status": "success", "message": f"Формула с ID {formula_id} обновлена."}
         except SQLAlchemyError as e:
             logger.error(f"Ошибка при обновлении формулы: {e}")
@@ -200,6 +384,7 @@ def manage_formula(latex_formula: LatexFormula, db: Session = Depends(get_db)):
             deleted = delete_formula(db, formula_id)
             if not deleted:
                 raise HTTPException(status_code=404, detail="Формула не найдена.")
+            record_change("delete", formula_id)
             return {"status": "success", "message": f"Формула с ID {formula_id} удалена."}
         except SQLAlchemyError as e:
             logger.error(f"Ошибка при удалении формулы: {e}")
@@ -209,23 +394,42 @@ def manage_formula(latex_formula: LatexFormula, db: Session = Depends(get_db)):
 
 
 @app.get("/formulas", response_model=List[FormulaResponse])
-def get_all_formulas_endpoint(db: Session = Depends(get_db)):
+def get_all_formulas_endpoint(http_request: Request, offset: int = 0, limit: Optional[int] = None,
+                              db: Session = Depends(get_db)):
+    """
+    Возвращает формулы каталога (всё или страницу offset/limit).
+    Поддерживает условный GET: ETag зависит от версии каталога, при совпадении
+    If-None-Match возвращается 304. Тело отдаётся из кеша готовых байтов
+    и сжимается по Accept-Encoding.
+    """
+    if offset < 0 or (limit is not None and limit <= 0):
+        raise HTTPException(status_code=400, detail="offset должен быть неотрицательным, limit - положительным.")
     try:
-        all_formulas = get_all_formulas(db)
-        if not all_formulas:
-            return []
-        return [
-            FormulaResponse(
-                id=formula.id,
-                latex_formula=formula.latex_formula,
-                author_id=formula.author_id,
-                legend=formula.legend,
-                description=formula.description,
-                creation_date=formula.creation_date.strftime("%Y-%m-%d %H:%M:%S") if formula.creation_date else None,
-                update_date=formula.update_date.strftime("%Y-%m-%d %H:%M:%S") if formula.update_date else None
-            )
-            for formula in all_formulas
-        ]
+        version = get_catalogue_version(db)
+        etag = catalogue_etag(version, offset, limit)
+        headers = {"Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+        if etag_matches(http_request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers={**headers, "ETag": etag})
+
+        encoding = choose_encoding(http_request.headers.get("accept-encoding"))
+        cached = catalogue_cache.get(version, offset, limit, encoding)
+        if cached is None:
+            formulas = get_formulas_page(db, offset, limit)
+            body = dumps([formula_to_dict(formula) for formula in formulas])
+            # Если каталог изменился во время чтения, тело не кешируется под старой версией
+            current_version = get_catalogue_version(db)
+            if current_version == version:
+                cached = catalogue_cache.put(version, offset, limit, body, encoding)
+            else:
+                # Строки могли быть прочитаны ещё в старой версии: ответ помечается старым ETag,
+                # чтобы следующий условный запрос не совпал с новой версией и получил свежие данные
+                cached = compress(body, encoding), encoding
+        body, encoding = cached
+
+        headers["ETag"] = encoded_etag(etag, encoding)
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(content=body, media_type="application/json", headers=headers)
     except SQLAlchemyError as e:
         logger.error(f"Ошибка при получении формул: {e}")
         raise HTTPException(status_code=500, detail=f"Ошибка при получении формул: {e}")
@@ -238,64 +442,207 @@ def find_similar_formulas(request: FindSimilarRequest, db: Session = Depends(get
     assumptions = None
 
     try:
-        all_formulas = get_all_formulas(db)
-        if not all_formulas:
-            return []
-
-        results = []
-        for formula in all_formulas:
-            try:
-                (equivalent,
-                 similarity,
-                 common_subexpressions,
-                 common_indices_in_expr2,
-                 substring_occurrences_in_simplified2,
-                 simplified1,
-                 simplified2) = compare_formulas_sympy(
-                    formula1=input_formula,
-                    formula2=formula.latex_formula,
-                    assumptions=assumptions
-                )
-
-                # Формируем список CommonSubexpressionInfo
-                common_info_list = []
-                for subexpr in common_subexpressions:
-                    common_info_list.append(CommonSubexpressionInfo(
-                        subexpression=subexpr,
-                        indices_in_expr2=common_indices_in_expr2[subexpr],
-                        occurrences_in_simplified2=substring_occurrences_in_simplified2[subexpr]
-                    ))
-
-                results.append(
-                    DetailedSimilarityInfo(
-                        formula=FormulaResponse(
-                            id=formula.id,
-                            latex_formula=formula.latex_formula,
-                            author_id=formula.author_id,
-                            legend=formula.legend,
-                            description=formula.description,
-                            creation_date=formula.creation_date.strftime("%Y-%m-%d %H:%M:%S") if formula.creation_date else None,
-                            update_date=formula.update_date.strftime("%Y-%m-%d %H:%M:%S") if formula.update_date else None
-                        ),
-                        equivalent=equivalent,
-                        similarity=similarity,
-                        simplified1=sympy.latex(simplified1),
-                        simplified2=sympy.latex(simplified2),
-                        common_subexpressions=common_info_list
-                    )
-                )
-            except Exception as e:
-                logger.error(f"Ошибка при сравнении формул ID {formula.id}: {e}")
-                continue
-
-        # Сортируем по сходству
-        results = sorted(results, key=lambda x: x.similarity, reverse=True)[:10]
-        return results
+        # Для сравнения читаются только id и LaTeX; полные строки - только для 10 лучших
+        sources = iter_formula_sources(db)
+        return find_similar(input_formula, sources, k=10, assumptions=assumptions,
+                            store=get_snapshot_store(), load_rows=lambda ids: get_formulas_by_ids(db, ids))
 
     except Exception as e:
         logger.error(f"Ошибка при поиске похожих формул: {e}")
         raise HTTPException(status_code=500, detail=f"Ошибка при поиске похожих формул: {e}")
 
+
+def _load_catalogue_version():
+    db = SessionLocal()
+    try:
+        return get_catalogue_version(db)
+    finally:
+        db.close()
+
+
+def _search_catalogue(input_formula: str):
+    db = SessionLocal()
+    try:
+        return find_similar(input_formula, iter_formula_sources(db), k=10, store=get_snapshot_store(),
+                            load_rows=lambda ids: get_formulas_by_ids(db, ids))
+    finally:
+        db.close()
+
+
+@app.post("/find_similar_async", response_model=List[DetailedSimilarityInfo])
+async def find_similar_formulas_async(request: FindSimilarRequest):
+    """
+    Асинхронный вариант /find_similar: сравнение выполняется в отдельном пуле потоков,
+    а одинаковые одновременные запросы (та же формула при той же версии каталога)
+    объединяются в одно вычисление.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        version = await loop.run_in_executor(search_executor, _load_catalogue_version)
+        key = (normalize_latex(request.formula), version)
+        return await search_coalescer.run(key, _search_catalogue, request.formula)
+    except Exception as e:
+        logger.error(f"Ошибка при поиске похожих формул: {e}")
+        raise HTTPException(status_code=500, detail=f"Ошибка при поиске похожих формул: {e}")
+
+
+def _load_formula_source_rows():
+    db = SessionLocal()
+    try:
+        return list(iter_formula_sources(db))
+    finally:
+        db.close()
+
+
+def _load_formula_rows(ids):
+    db = SessionLocal()
+    try:
+        return get_formulas_by_ids(db, ids)
+    finally:
+        db.close()
+
+
+@app.post("/find_similar_stream")
+async def find_similar_formulas_stream(request: FindSimilarRequest, http_request: Request, format: Optional[str] = None):
+    """
+    Потоковый вариант /find_similar: текущий top-K отправляется по мере сравнения формул.
+    Формат выбирается параметром format ("sse" или "ndjson"),
+    по умолчанию - по заголовку Accept (text/event-stream -> SSE, иначе NDJSON).
+    """
+    if format is None:
+        format = "sse" if SSE_MEDIA_TYPE in http_request.headers.get("accept", "") else "ndjson"
+    if format not in ("sse", "ndjson"):
+        raise HTTPException(status_code=400, detail="Неверный формат. Допустимые форматы: sse, ndjson.")
+
+    events = stream_similar(
+        request.formula,
+        # Для сравнения читаются только id и LaTeX; полные строки - для формул, попадающих в события
+        load_formulas=_load_formula_source_rows,
+        load_rows=_load_formula_rows,
+        executor=search_executor,
+        is_disconnected=http_request.is_disconnected,
+        k=10,
+        store=get_snapshot_store(),
+        formatter=format_sse if format == "sse" else format_ndjson,
+    )
+    return StreamingResponse(
+        events,
+        media_type=SSE_MEDIA_TYPE if format == "sse" else NDJSON_MEDIA_TYPE,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/render")
+async def render_formula_endpoint(http_request: Request, latex: str, format: str = "svg",
+                                  size: int = DEFAULT_FONT_SIZE, dpi: int = DEFAULT_DPI):
+    """
+    Возвращает картинку формулы (SVG или PNG) с размером шрифта size (пт) и разрешением dpi.
+    Картинки кешируются на диске; ETag - хеш параметров, при совпадении If-None-Match возвращается 304.
+    """
+    if format not in RENDER_FORMATS:
+        raise HTTPException(status_code=400, detail="Неверный формат. Допустимые форматы: svg, png.")
+    if not latex or len(latex) > MAX_LATEX_LENGTH:
+        raise HTTPException(status_code=400, detail=f"Формула должна быть непустой и не длиннее {MAX_LATEX_LENGTH} символов.")
+    if not MIN_FONT_SIZE <= size <= MAX_FONT_SIZE or not MIN_DPI <= dpi <= MAX_DPI:
+        raise HTTPException(status_code=400, detail=f"size должен быть от {MIN_FONT_SIZE} до {MAX_FONT_SIZE}, "
+                                                    f"dpi - от {MIN_DPI} до {MAX_DPI}.")
+
+    headers = {"Cache-Control": "public, max-age=31536000, immutable"}
+    etag = f'"{render_key(latex, format, size, dpi)}"'
+    if etag_matches(http_request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={**headers, "ETag": etag})
+    try:
+        # Первый вызов создаёт кеш и сканирует его каталог - это тоже делается вне цикла событий
+        renderer = await asyncio.get_running_loop().run_in_executor(None, get_renderer)
+        _, image = await renderer.render(latex, format, size, dpi)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Не удалось отрисовать формулу: {e}")
+    except Exception as e:
+        logger.error(f"Ошибка при отрисовке формулы: {e}")
+        raise HTTPException(status_code=500, detail=f"Ошибка при отрисовке формулы: {e}")
+    return Response(content=image, media_type=RENDER_FORMATS[format], headers={**headers, "ETag": etag})
+
+
+@app.post("/find_similar_sharded", response_model=ShardedSimilarityResponse)
+def find_similar_formulas_sharded(request: ShardedFindSimilarRequest):
+    """
+    Поиск похожих формул по всем шардам каталога (scatter-gather).
+    Адреса шардов задаются переменной окружения SEARCH_SHARD_URLS.
+    """
+    shard_urls = get_shard_urls()
+    if not shard_urls:
+        raise HTTPException(status_code=503, detail="Шардированный поиск не настроен (SEARCH_SHARD_URLS пуст).")
+    try:
+        return scatter_gather(request.formula, shard_urls, k=request.top_k, deadline=request.deadline)
+    except Exception as e:
+        logger.error(f"Ошибка при шардированном поиске похожих формул: {e}")
+        raise HTTPException(status_code=500, detail=f"Ошибка при шардированном поиске похожих формул: {e}")
+
+
+@app.post("/clusters/run")
+def run_clustering(request: ClusteringRequest):
+    """
+    Запускает (или продолжает с контрольной точки) фоновое задание
+    поиска дубликатов и почти эквивалентных формул.
+    """
+    started = start_background_job(
+        _load_formula_source_rows,
+        CLUSTER_CHECKPOINT_DIR,
+        restart=request.restart,
+        cosine_threshold=request.cosine_threshold,
+        similarity_threshold=request.similarity_threshold,
+    )
+    if not started:
+        return {"status": "running", "progress": load_progress(CLUSTER_CHECKPOINT_DIR)}
+    return {"status": "started"}
+
+
+@app.get("/clusters")
+def get_clusters():
+    """Возвращает состояние задания кластеризации и результат последнего завершённого запуска."""
+    return {
+        "running": is_job_running(),
+        "progress": load_progress(CLUSTER_CHECKPOINT_DIR),
+        "result": load_result(CLUSTER_CHECKPOINT_DIR),
+    }
+
+@app.get("/metrics")
+def get_metrics():
+    """Метрики планировщика (очереди и ожидание по классам эндпоинтов) и кешей."""
+    return {
+        "scheduler": admission_controller.metrics(),
+        "search_coalescer": {
+            "started": search_coalescer.started,
+            "coalesced": search_coalescer.coalesced,
+            "in_flight": search_coalescer.in_flight(),
+        },
+        "catalogue_cache": {"hits": catalogue_cache.hits, "misses": catalogue_cache.misses},
+    }
+
+
+def _check_profile_token(http_request: Request):
+    if PROFILE_TOKEN is None:
+        raise HTTPException(status_code=404, detail="Профилирование не настроено (PROFILE_TOKEN пуст).")
+    if not token_matches(http_request.headers.get(PROFILE_HEADER), PROFILE_TOKEN):
+        raise HTTPException(status_code=403, detail="Неверный токен профилирования.")
+
+
+@app.get("/admin/profiles")
+def get_profiles(http_request: Request):
+    """Список сохранённых профилей запросов. Требует заголовок X-Profile с токеном."""
+    _check_profile_token(http_request)
+    return list_profiles()
+
+
+@app.get("/admin/profiles/{profile_id}")
+def download_profile(profile_id: str, http_request: Request):
+    """Скачивание профиля в формате speedscope (открывается на https://www.speedscope.app)."""
+    _check_profile_token(http_request)
+    path = get_profile_path(profile_id)
+    if path is None:
+        raise HTTPException(status_code=404, detail="Профиль не найден.")
+    return FileResponse(path, media_type="application/json", filename=os.path.basename(path))
+
 # Используется в релиз версии
 
 # app.mount("/static", StaticFiles(directory="static"), name="static")
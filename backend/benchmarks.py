@@ -0,0 +1,209 @@
+# benchmarks.py
+"""
+Бенчмарки производительности бэкенда.
+
+    python benchmarks.py parser [--repeat N]      - быстрый парсер LaTeX против parse_latex
+    python benchmarks.py canonical [--repeat N]   - однопроходный canonical_form против прежнего рекурсивного
+    python benchmarks.py spans [--repeat N]       - печать LaTeX с картой позиций против sympy.latex
+    python benchmarks.py pdf [--formulas N]       - экспорт в PDF (векторные формулы) против DOCX с PNG
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import sympy
+from sympy import Add, Mul
+from sympy.core.cache import clear_cache
+from sympy.parsing.latex import parse_latex
+from matplotlib.textpath import TextPath
+
+from index import canonical_form, prepare_formula
+from jscon2pdf import json_to_docx, json_to_pdf
+from latex_parser import CONFORMANCE_CORPUS, UnsupportedLatex, check_conformance, parse_latex_native
+from latex_spans import latex_with_spans
+
+
+def measure(func, items, repeat):
+    """
+    Возвращает время (с) выполнения func для всех items, лучшее из repeat прогонов.
+    Перед каждым прогоном кеш SymPy очищается, чтобы прогоны не ускоряли друг друга.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        clear_cache()
+        started = time.perf_counter()
+        for item in items:
+            func(item)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def bench_parser(args):
+    mismatches, native_count = check_conformance()
+    print(f"Соответствие parse_latex: {native_count} из {len(CONFORMANCE_CORPUS)} формул "
+          f"разобраны быстрым парсером, расхождений: {len(mismatches)}")
+    for latex, expected, actual in mismatches:
+        print(f"  {latex!r}\n    parse_latex: {expected}\n    быстрый:     {actual}")
+
+    supported = []
+    for latex in CONFORMANCE_CORPUS:
+        try:
+            parse_latex_native(latex)
+            supported.append(latex)
+        except UnsupportedLatex:
+            pass
+
+    antlr_time = measure(parse_latex, supported, args.repeat)
+    native_time = measure(parse_latex_native, supported, args.repeat)
+    print(f"parse_latex:     {len(supported) / antlr_time:10.0f} формул/с")
+    print(f"быстрый парсер:  {len(supported) / native_time:10.0f} формул/с "
+          f"(ускорение x{antlr_time / native_time:.1f})")
+    return 1 if mismatches else 0
+
+
+def canonical_form_reference(expr):
+    """Прежняя реализация canonical_form (expand на каждом уровне рекурсии) - эталон для сравнения."""
+    expr = sympy.expand(expr)
+    if expr.is_Atom:
+        return expr
+    new_args = [canonical_form_reference(a) for a in expr.args]
+    if isinstance(expr, Add) or isinstance(expr, Mul):
+        new_args.sort(key=lambda x: sympy.srepr(x))
+        if isinstance(expr, Add):
+            return Add(*new_args, evaluate=False)
+        else:
+            return Mul(*new_args, evaluate=False)
+    else:
+        return type(expr)(*new_args)
+
+
+def canonical_corpus():
+    x, y, z, a, b = sympy.symbols("x y z a b")
+    x_1, x_2, x_3, x_4 = sympy.symbols("x_1 x_2 x_3 x_4")
+    half = sympy.Rational(1, 2)
+    return {
+        "(x+y+z+1)^6": (x + y + z + 1) ** 6,
+        "(x+y+z+1)^9": (x + y + z + 1) ** 9,
+        "(a+b)^12 (x-y)^4": (a + b) ** 12 * (x - y) ** 4,
+        "sin(x+y)^3 (x+1)^6 + exp(a b) (b-2)^7": sympy.sin(x + y) ** 3 * (x + 1) ** 6 + sympy.exp(a * b) * (b - 2) ** 7,
+        "sqrt(x^2+y^2) (x+y+z)^5 / (a+1)^3": sympy.sqrt(x ** 2 + y ** 2) * (x + y + z) ** 5 / (a + 1) ** 3,
+        # Степень с символьным показателем раскрывается в произведение внутри произведения
+        "... exp(sqrt(x_3)+x_3+2)^x_2 ...":
+            (sympy.sin(x_1 + half) + sympy.exp(sympy.sin(half))) * sympy.exp(sympy.sqrt(x_3) + x_3 + 2) ** x_2
+            * sympy.sin(sympy.sqrt(x_2 + sympy.E)),
+        # Аргумент экспоненты раскрывается в сумму только при повторном expand
+        "exp(((x_2-x_1) e^x_1 + cos(x_4))^2)": sympy.exp(((x_2 - x_1) * sympy.exp(x_1) + sympy.cos(x_4)) ** 2),
+    }
+
+
+def bench_canonical(args):
+    failures = 0
+    print(f"{'выражение':45} {'узлов':>7} {'прежний, с':>11} {'новый, с':>9} {'ускорение':>9}")
+    for name, expr in canonical_corpus().items():
+        expected = canonical_form_reference(expr)
+        actual = canonical_form(expr)
+        if sympy.srepr(expected) != sympy.srepr(actual):
+            failures += 1
+            print(f"{name}: канонические формы различаются")
+            continue
+        reference_time = measure(canonical_form_reference, [expr], args.repeat)
+        new_time = measure(canonical_form, [expr], args.repeat)
+        nodes = sum(1 for _ in sympy.preorder_traversal(actual))
+        print(f"{name:45} {nodes:7d} {reference_time:11.3f} {new_time:9.3f} {reference_time / new_time:8.1f}x")
+    return 1 if failures else 0
+
+
+def spans_corpus():
+    """Канонические формы формул корпуса парсера и выражений бенчмарка canonical."""
+    expressions = [canonical_form(expr) for expr in canonical_corpus().values()]
+    for latex in CONFORMANCE_CORPUS:
+        try:
+            prepared = prepare_formula(latex)
+        except Exception:
+            continue
+        expressions.extend([prepared.canonical_renamed, prepared.canonical_plain])
+    return expressions
+
+
+def bench_spans(args):
+    # Текст latex_with_spans не сверяется с sympy.latex при каждом сравнении формул,
+    # поэтому совпадение проверяется здесь
+    expressions = spans_corpus()
+    mismatches = 0
+    for expr in expressions:
+        printed = latex_with_spans(expr)
+        if printed is not None and printed[0] != sympy.latex(expr):
+            mismatches += 1
+            print(f"  {sympy.srepr(expr)}\n    sympy.latex: {sympy.latex(expr)}\n    с позициями: {printed[0]}")
+    print(f"Печать с позициями: {len(expressions)} выражений, расхождений с sympy.latex: {mismatches}")
+
+    plain_time = measure(sympy.latex, expressions, args.repeat)
+    spans_time = measure(latex_with_spans, expressions, args.repeat)
+    print(f"sympy.latex:        {plain_time:.3f} с")
+    print(f"latex_with_spans:   {spans_time:.3f} с (x{spans_time / plain_time:.2f} от sympy.latex)")
+    return 1 if mismatches else 0
+
+
+def export_corpus(count):
+    # DOCX-экспорт падает на формулах, которые не понимает mathtext, поэтому берутся только поддерживаемые
+    formulas = []
+    for latex in CONFORMANCE_CORPUS:
+        try:
+            TextPath((0, 0), f"${latex}$")
+            formulas.append(latex)
+        except ValueError:
+            pass
+    description = ("Описание формулы для проверки вёрстки: несколько предложений текста, "
+                   "которые переносятся на следующие строки и занимают место на странице. ") * 2
+    return [
+        {"latex_formula": formulas[i % len(formulas)], "legend": f"Формула {i + 1}",
+         "description": description}
+        for i in range(count)
+    ]
+
+
+def bench_pdf(args):
+    data = export_corpus(args.formulas)
+    directory = tempfile.mkdtemp(prefix="bench_export_")
+    try:
+        print(f"Экспорт {len(data)} формул")
+        results = {}
+        for name, export in (("DOCX + PNG", json_to_docx), ("PDF", json_to_pdf)):
+            started = time.perf_counter()
+            path = export(data, directory)
+            elapsed = time.perf_counter() - started
+            results[name] = (elapsed, os.path.getsize(path))
+            print(f"{name:12} {elapsed:8.2f} с {os.path.getsize(path) / 1024:10.0f} КБ")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    docx_time, docx_size = results["DOCX + PNG"]
+    pdf_time, pdf_size = results["PDF"]
+    print(f"PDF быстрее в {docx_time / pdf_time:.1f} раза, меньше в {docx_size / pdf_size:.1f} раза")
+    return 0 if pdf_time < docx_time and pdf_size < docx_size else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарки бэкенда")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    parser_bench = subparsers.add_parser("parser", help="Быстрый парсер LaTeX против parse_latex")
+    parser_bench.add_argument("--repeat", type=int, default=5)
+    parser_bench.set_defaults(func=bench_parser)
+
+    canonical_bench = subparsers.add_parser("canonical", help="Однопроходный canonical_form против прежнего")
+    canonical_bench.add_argument("--repeat", type=int, default=3)
+    canonical_bench.set_defaults(func=bench_canonical)
+
+    spans_bench = subparsers.add_parser("spans", help="Печать LaTeX с картой позиций против sympy.latex")
+    spans_bench.add_argument("--repeat", type=int, default=3)
+    spans_bench.set_defaults(func=bench_spans)
+
+    pdf_bench = subparsers.add_parser("pdf", help="Экспорт в PDF против DOCX с PNG")
+    pdf_bench.add_argument("--formulas", type=int, default=200)
+    pdf_bench.set_defaults(func=bench_pdf)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
@@ -0,0 +1,144 @@
+# catalogue_cache.py
+"""
+Кеш сериализованных ответов /formulas.
+
+Версия каталога (число формул и время последнего изменения, см. get_catalogue_version)
+превращается в ETag: если клиент присылает If-None-Match с текущим ETag,
+API отвечает 304 без тела. Иначе тело берётся из кеша готовых байтов
+(ключ - версия каталога и страница), а при промахе сериализуется один раз
+быстрым JSON-кодировщиком (orjson, если установлен) и при необходимости
+сжимается gzip или brotli. Сжатые варианты тоже кешируются.
+"""
+import gzip
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Тела меньше этого размера не сжимаются
+MIN_COMPRESS_SIZE = 1024
+MAX_CACHED_PAGES = 32
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def dumps(data):
+    """Сериализует данные в JSON (bytes, UTF-8)."""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def catalogue_etag(version, offset=0, limit=None):
+    """ETag несжатого ответа для версии каталога и страницы."""
+    count, last_update = version
+    digest = hashlib.blake2b(f"{count}|{last_update}|{offset}|{limit}".encode("utf-8"), digest_size=8).hexdigest()
+    return f'"{count}-{digest}"'
+
+
+def encoded_etag(etag, encoding):
+    """ETag сжатого ответа: байты различаются, поэтому к ETag добавляется сжатие."""
+    if encoding == "identity":
+        return etag
+    return f'{etag[:-1]}-{encoding}"'
+
+
+def etag_matches(if_none_match, etag):
+    """
+    Проверяет заголовок If-None-Match (список ETag или "*") для несжатого ETag etag.
+    Подходит ETag любого сжатия той же версии; слабые ETag сравниваются по значению.
+    """
+    if not if_none_match:
+        return False
+    variants = {etag, encoded_etag(etag, "gzip"), encoded_etag(etag, "br")}
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == "*" or candidate in variants:
+            return True
+    return False
+
+
+def choose_encoding(accept_encoding):
+    """Выбирает сжатие по заголовку Accept-Encoding: br (если доступен brotli), gzip или без сжатия."""
+    accepted = set()
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(name.strip().lower())
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted:
+        return "gzip"
+    return "identity"
+
+
+def compress(body, encoding):
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return body
+
+
+class CatalogueCache:
+    """LRU-кеш готовых тел ответа по ключу (версия каталога, offset, limit)."""
+
+    def __init__(self, max_pages=MAX_CACHED_PAGES):
+        self._pages = OrderedDict()
+        self._max_pages = max_pages
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, version, offset, limit, encoding):
+        """
+        Возвращает пару (тело, сжатие) из кеша или None.
+        Сжатие может оказаться "identity", если тело слишком маленькое.
+        """
+        key = (version, offset, limit)
+        with self._lock:
+            variants = self._pages.get(key)
+            if variants is None:
+                self.misses += 1
+                return None
+            self._pages.move_to_end(key)
+            self.hits += 1
+        return self._variant(variants, encoding)
+
+    def put(self, version, offset, limit, body, encoding):
+        """Сохраняет несжатое тело страницы и возвращает пару (тело, сжатие) для ответа."""
+        variants = {"identity": body}
+        with self._lock:
+            self._pages[(version, offset, limit)] = variants
+            self._pages.move_to_end((version, offset, limit))
+            while len(self._pages) > self._max_pages:
+                self._pages.popitem(last=False)
+        return self._variant(variants, encoding)
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+
+    def _variant(self, variants, encoding):
+        body = variants["identity"]
+        if encoding == "identity" or len(body) < MIN_COMPRESS_SIZE:
+            return body, "identity"
+        compressed = variants.get(encoding)
+        if compressed is None:
+            # Гонка двух потоков здесь безвредна: оба получат одинаковые байты
+            compressed = compress(body, encoding)
+            variants[encoding] = compressed
+        return compressed, encoding
@@ -0,0 +1,200 @@
+# changefeed.py
+"""
+Лента изменений каталога формул для согласования кешей между воркерами.
+
+create_formula, update_formula и delete_formula (db.py) публикуют событие
+изменения в той же транзакции, что и саму запись. Каждый процесс API
+подписывается на ленту и обновляет свои структуры поиска (снапшот и т.п.)
+инкрементально.
+
+Брокеры:
+- PostgresBroker - NOTIFY в транзакции записи (доставляется только после COMMIT)
+  и отдельное соединение с LISTEN в фоновом потоке каждого воркера;
+- InProcessBroker - доставка подписчикам своего процесса после COMMIT сессии.
+  Используется для SQLite, тестов и запуска в один воркер.
+
+Событие - словарь {"op": "upsert" | "delete", "id": ..., "latex": ...}.
+latex может отсутствовать (слишком длинная формула для NOTIFY) - тогда
+подписчик сам читает формулу из базы. После переподключения к базе
+подписчики получают событие {"op": "resync"}: изменения, сделанные
+во время разрыва, могли быть пропущены.
+"""
+import json
+import logging
+import os
+import select
+import threading
+
+from sqlalchemy import event, text
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "formula_changes"
+# Полезная нагрузка NOTIFY ограничена 8000 байт
+MAX_NOTIFY_PAYLOAD = 7900
+# Ключ session.info с событиями, ожидающими COMMIT
+PENDING_KEY = "formula_changes"
+LISTEN_POLL_INTERVAL = 1.0
+RECONNECT_DELAY = 5.0
+
+
+class InProcessBroker:
+    """Брокер в пределах одного процесса: события доставляются подписчикам после COMMIT."""
+
+    def __init__(self):
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self.published = 0
+        self.delivered = 0
+
+    def subscribe(self, handler):
+        with self._lock:
+            self._subscribers.append(handler)
+
+    def unsubscribe(self, handler):
+        with self._lock:
+            if handler in self._subscribers:
+                self._subscribers.remove(handler)
+
+    def publish(self, session, change):
+        """Откладывает событие до COMMIT сессии; при ROLLBACK оно отбрасывается."""
+        session.info.setdefault(PENDING_KEY, []).append((self, change))
+        self.published += 1
+
+    def deliver(self, change):
+        """Передаёт событие всем подписчикам. Ошибка одного подписчика не мешает остальным."""
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for handler in subscribers:
+            try:
+                handler(change)
+            except Exception as e:
+                logger.error(f"Ошибка обработки изменения каталога {change}: {e}")
+        self.delivered += 1
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class PostgresBroker(InProcessBroker):
+    """Брокер на LISTEN/NOTIFY PostgreSQL: события видят все процессы, подключённые к базе."""
+
+    def __init__(self, engine, channel=CHANNEL):
+        super().__init__()
+        self._engine = engine
+        self._channel = channel
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def publish(self, session, change):
+        payload = json.dumps(change, ensure_ascii=False)
+        if len(payload.encode("utf-8")) > MAX_NOTIFY_PAYLOAD:
+            payload = json.dumps({key: value for key, value in change.items() if key != "latex"})
+        # NOTIFY внутри транзакции отправляется только при COMMIT и отменяется при ROLLBACK
+        session.execute(text("SELECT pg_notify(:channel, :payload)"),
+                        {"channel": self._channel, "payload": payload})
+        self.published += 1
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._listen_forever, name="changefeed", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=LISTEN_POLL_INTERVAL * 2)
+            self._thread = None
+
+    def _listen_forever(self):
+        first = True
+        while not self._stopped.is_set():
+            try:
+                self._listen(resync=not first)
+            except Exception as e:
+                logger.error(f"Соединение ленты изменений потеряно: {e}")
+            first = False
+            self._stopped.wait(RECONNECT_DELAY)
+
+    def _listen(self, resync):
+        connection = self._engine.raw_connection()
+        try:
+            dbapi_connection = connection.driver_connection
+            dbapi_connection.autocommit = True
+            with dbapi_connection.cursor() as cursor:
+                cursor.execute(f'LISTEN "{self._channel}"')
+            logger.info(f"Лента изменений: подписка на канал {self._channel}")
+            if resync:
+                self.deliver({"op": "resync"})
+
+            while not self._stopped.is_set():
+                if select.select([dbapi_connection], [], [], LISTEN_POLL_INTERVAL) == ([], [], []):
+                    continue
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    notification = dbapi_connection.notifies.pop(0)
+                    try:
+                        change = json.loads(notification.payload)
+                    except ValueError:
+                        logger.error(f"Некорректное событие ленты изменений: {notification.payload!r}")
+                        continue
+                    self.deliver(change)
+        finally:
+            # Соединение в режиме autocommit с активным LISTEN не возвращается в пул
+            connection.invalidate()
+
+
+@event.listens_for(Session, "after_commit")
+def _deliver_pending(session):
+    for broker, change in session.info.pop(PENDING_KEY, ()):
+        broker.deliver(change)
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_pending(session):
+    session.info.pop(PENDING_KEY, None)
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def create_broker(engine):
+    """
+    Выбирает брокер для движка: PostgresBroker для PostgreSQL, иначе InProcessBroker.
+    Переменная окружения FORMULA_CHANGEFEED=inprocess принудительно включает InProcessBroker.
+    """
+    if engine.dialect.name == "postgresql" and os.environ.get("FORMULA_CHANGEFEED") != "inprocess":
+        return PostgresBroker(engine)
+    return InProcessBroker()
+
+
+def get_broker(engine):
+    """Возвращает брокер процесса, создавая его при первом обращении."""
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            _broker = create_broker(engine)
+        return _broker
+
+
+def set_broker(broker):
+    """Подменяет брокер процесса (например, на InProcessBroker в тестах). Возвращает прежний."""
+    global _broker
+    with _broker_lock:
+        previous, _broker = _broker, broker
+        return previous
+
+
+def publish_change(session: Session, op, formula_id, latex_formula=None):
+    """Публикует изменение формулы в транзакции сессии."""
+    change = {"op": op, "id": formula_id}
+    if latex_formula is not None:
+        change["latex"] = latex_formula
+    get_broker(session.get_bind()).publish(session, change)
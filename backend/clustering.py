@@ -0,0 +1,475 @@
+# clustering.py
+"""
+Поиск дубликатов и почти эквивалентных формул по всему каталогу.
+
+Попарный compare_formulas_sympy для всего каталога - O(n^2) вызовов SymPy,
+поэтому задача решается в три этапа:
+    1. features   - для каждой формулы в пуле процессов вычисляются prepare_formula
+                    и компактный признак: хеши поддеревьев канонической формы
+                    и числовой отпечаток;
+    2. candidates - хеши поддеревьев превращаются в разреженные векторы (hashing trick),
+                    признаки, встречающиеся более чем в max_feature_frequency формулах
+                    (листья вроде x_1, -1, 2 есть почти везде), отбрасываются - иначе
+                    произведение матриц почти плотное; косинусная близость по оставшимся
+                    признакам считается блоками разреженного умножения матриц (только
+                    верхний треугольник), пары с близостью выше порога и пары с одинаковым
+                    отпечатком становятся кандидатами;
+    3. confirm    - кандидаты проверяются compare_formulas_sympy в пуле процессов,
+                    подтверждённые пары объединяются в кластеры (union-find).
+
+После каждого блока состояние сохраняется в каталог контрольных точек
+(признаки, кандидаты и подтверждённые пары дописываются в JSONL-файлы,
+в state.json - только счётчики и смещения), поэтому прерванное задание
+продолжается с места остановки:
+    python clustering.py --checkpoint-dir cluster_job
+"""
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import sparse
+
+from index import compare_formulas_sympy, prepare_formula
+
+logger = logging.getLogger(__name__)
+
+FEATURE_DIM = 1 << 18
+DEFAULT_BLOCK_SIZE = 1024
+DEFAULT_COSINE_THRESHOLD = 0.8
+DEFAULT_SIMILARITY_THRESHOLD = 90.0
+# Признак (хеш поддерева), встречающийся в большем числе формул, не участвует в поиске кандидатов
+DEFAULT_MAX_FEATURE_FREQUENCY = 200
+CONFIRM_BATCH_SIZE = 256
+
+STATE_FILE = "state.json"
+FEATURES_FILE = "features.jsonl"
+IDS_FILE = "ids.json"
+CANDIDATES_FILE = "candidates.jsonl"
+CONFIRMED_FILE = "confirmed.jsonl"
+RESULT_FILE = "clusters.json"
+
+
+def compute_features(item):
+    """Вычисляет признаки одной формулы (выполняется в процессе пула)."""
+    formula_id, latex_formula = item
+    try:
+        prepared = prepare_formula(latex_formula)
+    except Exception as e:
+        return {"id": formula_id, "error": str(e)}
+    return {
+        "id": formula_id,
+        "num_vars": prepared.num_vars,
+        "hashes": prepared.hashes,
+        "fingerprint": prepared.fingerprint,
+    }
+
+
+def confirm_pair(item):
+    """Проверяет пару кандидатов символьно (выполняется в процессе пула)."""
+    id1, latex1, id2, latex2 = item
+    try:
+        equivalent, similarity = compare_formulas_sympy(latex1, latex2)[:2]
+    except Exception as e:
+        logger.error(f"Не удалось сравнить формулы ID {id1} и {id2}: {e}")
+        return id1, id2, False, 0.0
+    return id1, id2, equivalent, similarity
+
+
+def build_feature_matrix(features, max_feature_frequency=DEFAULT_MAX_FEATURE_FREQUENCY):
+    """
+    Строит разреженную матрицу признаков (строка - формула) с нормированными строками.
+    Каждый хеш поддерева отображается в один из FEATURE_DIM столбцов. Столбцы, заполненные
+    более чем в max_feature_frequency строках, обнуляются: каждый такой признак дал бы
+    квадратичное по числу формул количество произведений, почти не отличая формулы друг от друга.
+    """
+    rows, cols = [], []
+    for row, feature in enumerate(features):
+        columns = {h % FEATURE_DIM for h in feature["hashes"]}
+        rows.extend([row] * len(columns))
+        cols.extend(columns)
+    data = np.ones(len(rows), dtype=np.float32)
+    matrix = sparse.csr_matrix((data, (rows, cols)), shape=(len(features), FEATURE_DIM))
+    if max_feature_frequency is not None:
+        frequency = np.bincount(matrix.indices, minlength=FEATURE_DIM)
+        matrix = matrix.dot(sparse.diags((frequency <= max_feature_frequency).astype(np.float32))).tocsr()
+        matrix.eliminate_zeros()
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.0
+    return sparse.diags(1.0 / norms).dot(matrix).tocsr()
+
+
+def block_candidates(matrix, start, stop, threshold):
+    """
+    Возвращает пары строк (i, j), i < j, i в [start, stop), с косинусной близостью >= threshold.
+    Блок умножается только на строки с номерами от start: пары с j < start найдены в предыдущих блоках.
+    """
+    similarity = matrix[start:stop].dot(matrix[start:].T).tocoo()
+    mask = (similarity.data >= threshold) & (similarity.col > similarity.row)
+    return list(zip((similarity.row[mask] + start).tolist(), (similarity.col[mask] + start).tolist()))
+
+
+def fingerprint_groups(features):
+    """
+    Номер группы для каждой строки: в одну группу попадают формулы с одинаковым числом
+    переменных и одинаковым числовым отпечатком, а без отпечатка - с одинаковыми хешами поддеревьев.
+    """
+    keys = {}
+    groups = []
+    for feature in features:
+        if feature["fingerprint"] is not None:
+            key = (feature["num_vars"], json.dumps(feature["fingerprint"]))
+        else:
+            key = (feature["num_vars"], tuple(feature["hashes"]))
+        groups.append(keys.setdefault(key, len(keys)))
+    return groups
+
+
+def fingerprint_candidates(groups):
+    """
+    Пары строк одной группы (см. fingerprint_groups). Для кластеров достаточно связать каждую
+    формулу группы с первой: m - 1 символьное сравнение вместо m(m - 1) / 2.
+    """
+    first = {}
+    pairs = []
+    for row, group in enumerate(groups):
+        if group in first:
+            pairs.append((first[group], row))
+        else:
+            first[group] = row
+    return pairs
+
+
+def build_clusters(pairs):
+    """Объединяет подтверждённые пары в кластеры (union-find)."""
+    parent = {}
+
+    def find(x):
+        parent.setdefault(x, x)
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for a, b in pairs:
+        root_a, root_b = find(a), find(b)
+        if root_a != root_b:
+            parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    clusters = {}
+    for x in parent:
+        clusters.setdefault(find(x), []).append(x)
+    return sorted((sorted(members) for members in clusters.values()), key=lambda c: (-len(c), c[0]))
+
+
+class ClusteringJob:
+    """
+    Задание кластеризации каталога с контрольными точками в checkpoint_dir.
+
+    Списки пар не хранятся в state.json: кандидаты и подтверждённые пары дописываются
+    в JSONL-файлы, а в состоянии остаются только счётчики и длины этих файлов на момент
+    последней контрольной точки. Порядок формул, по которому считаются блоки, сохраняется
+    в ids.json, поэтому изменения каталога между запусками не сдвигают блоки.
+    """
+
+    def __init__(self, checkpoint_dir, workers=None, block_size=DEFAULT_BLOCK_SIZE,
+                 cosine_threshold=DEFAULT_COSINE_THRESHOLD,
+                 similarity_threshold=DEFAULT_SIMILARITY_THRESHOLD,
+                 max_feature_frequency=DEFAULT_MAX_FEATURE_FREQUENCY):
+        self.checkpoint_dir = checkpoint_dir
+        self.workers = workers
+        self.block_size = block_size
+        self.cosine_threshold = cosine_threshold
+        self.similarity_threshold = similarity_threshold
+        self.max_feature_frequency = max_feature_frequency
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self.state = self._load_state()
+
+    def _path(self, name):
+        return os.path.join(self.checkpoint_dir, name)
+
+    def _load_state(self):
+        if os.path.exists(self._path(STATE_FILE)):
+            with open(self._path(STATE_FILE), encoding="utf-8") as f:
+                state = json.load(f)
+            if not isinstance(state.get("candidates"), list):
+                return state
+            # Состояние старого формата (списки пар в state.json): этапы после признаков выполняются заново
+            logger.warning("Контрольная точка старого формата: поиск кандидатов начинается заново")
+        return {
+            "phase": "features",
+            "fingerprints_done": False,
+            "blocks_done": 0,
+            "candidates": 0,
+            "candidates_offset": 0,
+            "checked": 0,
+            "confirmed": 0,
+            "confirmed_offset": 0,
+            "started_at": time.time(),
+            "updated_at": time.time(),
+        }
+
+    def _write_json(self, name, data):
+        tmp_path = self._path(name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, self._path(name))
+
+    def _save_state(self):
+        self.state["updated_at"] = time.time()
+        self._write_json(STATE_FILE, self.state)
+
+    def _open_log(self, name, offset):
+        """Открывает JSONL-файл для дозаписи, отбрасывая записанное после последней контрольной точки."""
+        f = open(self._path(name), "ab")
+        f.truncate(offset)
+        return f
+
+    def _read_log(self, name, count):
+        """Читает первые count записей JSONL-файла."""
+        if count == 0:
+            return
+        with open(self._path(name), encoding="utf-8") as f:
+            for line in itertools.islice(f, count):
+                yield json.loads(line)
+
+    def _load_features(self):
+        features = {}
+        if os.path.exists(self._path(FEATURES_FILE)):
+            with open(self._path(FEATURES_FILE), encoding="utf-8") as f:
+                for line in f:
+                    # Последняя строка могла быть записана не полностью при прерывании
+                    try:
+                        feature = json.loads(line)
+                    except ValueError:
+                        continue
+                    features[feature["id"]] = feature
+        return features
+
+    def run(self, formulas):
+        """
+        Выполняет (или продолжает) задание для списка пар (id, latex_formula).
+        Возвращает результат: кластеры (списки id формул) и статистику задания.
+        """
+        latex_by_id = dict(formulas)
+        # spawn: задание может запускаться из фонового потока веб-сервера,
+        # а fork многопоточного процесса небезопасен
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=context) as pool:
+            features = self._run_features(pool, formulas)
+            with open(self._path(IDS_FILE), encoding="utf-8") as f:
+                ids = json.load(f)
+            if self.state["phase"] == "candidates":
+                self._run_candidates([features[formula_id] for formula_id in ids])
+            if self.state["phase"] == "confirm":
+                self._run_confirm(pool, latex_by_id)
+
+        confirmed = list(self._read_log(CONFIRMED_FILE, self.state["confirmed"]))
+        clusters = build_clusters(
+            (a, b) for a, b, equivalent, similarity in confirmed
+            if equivalent or similarity >= self.similarity_threshold
+        )
+        # Подтверждены только рёбра, связывающие кластер, а не все пары его формул; эквивалентность
+        # транзитивна, поэтому кластер эквивалентен, если он связан одними эквивалентными рёбрами
+        equivalence_class = {
+            formula_id: index
+            for index, members in enumerate(build_clusters((a, b) for a, b, equivalent, _ in confirmed if equivalent))
+            for formula_id in members
+        }
+        result = {
+            "clusters": [
+                {
+                    "ids": cluster,
+                    "equivalent": cluster[0] in equivalence_class
+                                  and all(equivalence_class.get(formula_id) == equivalence_class[cluster[0]]
+                                          for formula_id in cluster),
+                }
+                for cluster in clusters
+            ],
+            "formulas": len(formulas),
+            "skipped": len(formulas) - len(ids),
+            "candidates": self.state["candidates"],
+            "finished_at": time.time(),
+        }
+        self._write_json(RESULT_FILE, result)
+        self.state["phase"] = "done"
+        self._save_state()
+        return result
+
+    def _run_features(self, pool, formulas):
+        features = self._load_features()
+        if self.state["phase"] != "features":
+            return features
+        pending = [item for item in formulas if item[0] not in features]
+        logger.info(f"Признаки: готово {len(features)}, осталось {len(pending)}")
+        with open(self._path(FEATURES_FILE), "a", encoding="utf-8") as f:
+            # Отделяем новые записи от оборванной последней строки, если она есть
+            if f.tell() > 0:
+                f.write("\n")
+            for start in range(0, len(pending), self.block_size):
+                batch = pending[start:start + self.block_size]
+                for feature in pool.map(compute_features, batch, chunksize=16):
+                    features[feature["id"]] = feature
+                    f.write(json.dumps(feature) + "\n")
+                f.flush()
+                logger.info(f"Признаки: {start + len(batch)} из {len(pending)}")
+        # Порядок формул фиксируется: по нему нумеруются строки матрицы и блоки
+        self._write_json(IDS_FILE, [formula_id for formula_id, _ in formulas
+                                    if formula_id in features and "error" not in features[formula_id]])
+        self.state["phase"] = "candidates"
+        self._save_state()
+        return features
+
+    def _checkpoint_candidates(self, f, count):
+        f.flush()
+        self.state["candidates"] += count
+        self.state["candidates_offset"] = f.tell()
+
+    def _run_candidates(self, usable):
+        matrix = build_feature_matrix(usable, self.max_feature_frequency)
+        ids = [feature["id"] for feature in usable]
+        # Пары внутри групп с одинаковым отпечатком записываются первыми (по одной на формулу);
+        # пары строк одной группы из блоков пропускаются - группа уже связана
+        groups = fingerprint_groups(usable)
+        fingerprint_pairs = [(ids[a], ids[b]) for a, b in fingerprint_candidates(groups)]
+
+        with self._open_log(CANDIDATES_FILE, self.state["candidates_offset"]) as f:
+            if not self.state["fingerprints_done"]:
+                for pair in fingerprint_pairs:
+                    f.write((json.dumps(pair) + "\n").encode("utf-8"))
+                self._checkpoint_candidates(f, len(fingerprint_pairs))
+                self.state["fingerprints_done"] = True
+                self._save_state()
+
+            n_blocks = (len(usable) + self.block_size - 1) // self.block_size
+            for block in range(self.state["blocks_done"], n_blocks):
+                start = block * self.block_size
+                stop = min(start + self.block_size, len(usable))
+                pairs = [(ids[a], ids[b]) for a, b in block_candidates(matrix, start, stop, self.cosine_threshold)
+                         if groups[a] != groups[b]]
+                for pair in pairs:
+                    f.write((json.dumps(pair) + "\n").encode("utf-8"))
+                self._checkpoint_candidates(f, len(pairs))
+                self.state["blocks_done"] = block + 1
+                self._save_state()
+                logger.info(f"Кандидаты: блок {block + 1} из {n_blocks}, пар {self.state['candidates']}")
+
+        self.state["phase"] = "confirm"
+        self._save_state()
+
+    def _run_confirm(self, pool, latex_by_id):
+        total = self.state["candidates"]
+        candidates = itertools.islice(self._read_log(CANDIDATES_FILE, total), self.state["checked"], None)
+        with self._open_log(CONFIRMED_FILE, self.state["confirmed_offset"]) as f:
+            while self.state["checked"] < total:
+                chunk = list(itertools.islice(candidates, CONFIRM_BATCH_SIZE))
+                if not chunk:
+                    logger.error(f"Файл кандидатов короче ожидаемого: {self.state['checked']} из {total} пар")
+                    break
+                batch = [(a, latex_by_id[a], b, latex_by_id[b]) for a, b in chunk
+                         if a in latex_by_id and b in latex_by_id]
+                for a, b, equivalent, similarity in pool.map(confirm_pair, batch, chunksize=8):
+                    if equivalent or similarity >= self.similarity_threshold:
+                        f.write((json.dumps([a, b, equivalent, similarity]) + "\n").encode("utf-8"))
+                        self.state["confirmed"] += 1
+                f.flush()
+                self.state["confirmed_offset"] = f.tell()
+                self.state["checked"] += len(chunk)
+                self._save_state()
+                logger.info(f"Проверка: {self.state['checked']} из {total} пар")
+
+
+def load_result(checkpoint_dir):
+    """Возвращает результат последнего завершённого задания или None."""
+    path = os.path.join(checkpoint_dir, RESULT_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_progress(checkpoint_dir):
+    """Возвращает состояние задания (без списков пар) или None."""
+    path = os.path.join(checkpoint_dir, STATE_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        state = json.load(f)
+    return {
+        "phase": state["phase"],
+        "blocks_done": state["blocks_done"],
+        "candidates": state["candidates"],
+        "checked": state["checked"],
+        "confirmed": state["confirmed"],
+        "updated_at": state["updated_at"],
+    }
+
+
+_job_thread = None
+_job_lock = threading.Lock()
+
+
+def start_background_job(load_formulas, checkpoint_dir, restart=False, **params):
+    """
+    Запускает задание в фоновом потоке, если оно ещё не выполняется.
+    load_formulas - функция без аргументов, возвращающая пары (id, latex_formula).
+    restart=True начинает задание заново, иначе незавершённое задание продолжается.
+    Возвращает True, если задание запущено, и False, если оно уже выполнялось.
+    """
+    global _job_thread
+    with _job_lock:
+        if _job_thread is not None and _job_thread.is_alive():
+            return False
+        if restart or (load_progress(checkpoint_dir) or {}).get("phase") == "done":
+            for name in (STATE_FILE, FEATURES_FILE, IDS_FILE, CANDIDATES_FILE, CONFIRMED_FILE):
+                if os.path.exists(os.path.join(checkpoint_dir, name)):
+                    os.remove(os.path.join(checkpoint_dir, name))
+
+        def target():
+            try:
+                ClusteringJob(checkpoint_dir, **params).run(load_formulas())
+            except Exception as e:
+                logger.error(f"Ошибка задания кластеризации: {e}")
+
+        _job_thread = threading.Thread(target=target, name="clustering-job", daemon=True)
+        _job_thread.start()
+        return True
+
+
+def is_job_running():
+    return _job_thread is not None and _job_thread.is_alive()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Кластеризация дубликатов формул каталога")
+    parser.add_argument("--checkpoint-dir", default="cluster_job")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE)
+    parser.add_argument("--cosine-threshold", type=float, default=DEFAULT_COSINE_THRESHOLD)
+    parser.add_argument("--similarity-threshold", type=float, default=DEFAULT_SIMILARITY_THRESHOLD)
+    parser.add_argument("--max-feature-frequency", type=int, default=DEFAULT_MAX_FEATURE_FREQUENCY,
+                        help="Признаки, встречающиеся в большем числе формул, не учитываются при поиске кандидатов")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    from db import SessionLocal, iter_formula_sources
+
+    db = SessionLocal()
+    try:
+        formulas = [(formula.id, formula.latex_formula) for formula in iter_formula_sources(db)]
+    finally:
+        db.close()
+
+    job = ClusteringJob(args.checkpoint_dir, workers=args.workers, block_size=args.block_size,
+                        cosine_threshold=args.cosine_threshold,
+                        similarity_threshold=args.similarity_threshold,
+                        max_feature_frequency=args.max_feature_frequency)
+    result = job.run(formulas)
+    print(f"Кластеров: {len(result['clusters'])}, кандидатов: {result['candidates']}, "
+          f"пропущено формул: {result['skipped']}")
@@ -0,0 +1,57 @@
+# coalesce.py
+"""
+Объединение одинаковых одновременных запросов (request coalescing).
+
+Если несколько клиентов одновременно запрашивают одно и то же вычисление
+(одинаковый ключ), оно выполняется в пуле потоков один раз,
+а результат получают все ожидающие. Результат не кешируется:
+после завершения вычисления следующий запрос с тем же ключом
+запускает его заново.
+"""
+import asyncio
+import contextvars
+import logging
+from concurrent.futures import Executor, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class RequestCoalescer:
+    def __init__(self, executor: Executor):
+        self._executor = executor
+        # run_in_executor не переносит контекстные переменные (например, профиль запроса)
+        # в пул потоков; в пул процессов контекст передать нельзя
+        self._propagate_context = isinstance(executor, ThreadPoolExecutor)
+        self._in_flight = {}
+        self.started = 0
+        self.coalesced = 0
+
+    def in_flight(self):
+        """Число выполняющихся сейчас вычислений."""
+        return len(self._in_flight)
+
+    async def run(self, key, func, *args):
+        """
+        Выполняет func(*args) в пуле потоков или присоединяется к уже идущему
+        вычислению с тем же ключом. Должен вызываться из цикла событий.
+        """
+        future = self._in_flight.get(key)
+        if future is None:
+            loop = asyncio.get_running_loop()
+            if self._propagate_context:
+                future = loop.run_in_executor(self._executor, contextvars.copy_context().run, func, *args)
+            else:
+                future = loop.run_in_executor(self._executor, func, *args)
+            self._in_flight[key] = future
+            future.add_done_callback(lambda done: self._forget(key, done))
+            self.started += 1
+        else:
+            self.coalesced += 1
+            logger.info(f"Запрос присоединён к выполняющемуся вычислению (в работе: {len(self._in_flight)})")
+        # shield: отмена одного ожидающего (например, разрыв соединения)
+        # не должна отменять вычисление для остальных
+        return await asyncio.shield(future)
+
+    def _forget(self, key, future):
+        if self._in_flight.get(key) is future:
+            del self._in_flight[key]
@@ -1,10 +1,12 @@
 # db.py
 
-from sqlalchemy import create_engine, Column, Integer, Text, TIMESTAMP, func
+from sqlalchemy import create_engine, Column, Integer, Text, TIMESTAMP, func, or_
 from sqlalchemy.orm import declarative_base, sessionmaker, validates, Session
 from sqlalchemy.exc import SQLAlchemyError
 import os
 
+from changefeed import publish_change
+
 # Настройки подключения к базе данных
 DB_USERNAME = 'admin'
 DB_PASSWORD = 'pinpinpin'  # Рекомендуется использовать переменные окружения для хранения пароля
@@ -12,10 +14,15 @@ DB_HOST = 'localhost'
 DB_PORT = '5432'
 DB_NAME = 'formula_db'
 
-DATABASE_URL = f'postgresql://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}'
+# Переменная окружения DATABASE_URL позволяет подключиться к другой базе (например, SQLite для нагрузочных тестов)
+DATABASE_URL = os.environ.get('DATABASE_URL', f'postgresql://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}')
 
 # Создание движка и сессии
-engine = create_engine(DATABASE_URL, echo=False)
+if DATABASE_URL.startswith('sqlite'):
+    # Сессии SQLite используются из пула потоков FastAPI
+    engine = create_engine(DATABASE_URL, echo=False, connect_args={'check_same_thread': False})
+else:
+    engine = create_engine(DATABASE_URL, echo=False)
 SessionLocal = sessionmaker(bind=engine)
 
 Base = declarative_base()
@@ -94,6 +101,8 @@ def create_formula(db: Session, latex_formula, author_id, legend=None, descripti
             description=description
         )
         db.add(new_formula)
+        db.flush()
+        publish_change(db, "upsert", new_formula.id, new_formula.latex_formula)
         db.commit()
         db.refresh(new_formula)
         print(f"Формула с ID {new_formula.id} создана.")
@@ -119,6 +128,7 @@ def update_formula(db: Session, formula_id, **kwargs):
                 setattr(formula, key, value)
             else:
                 print(f"Поле '{key}' не существует в модели Formula или значение None.")
+        publish_change(db, "upsert", formula.id, formula.latex_formula)
         db.commit()
         db.refresh(formula)
         print(f"Формула с ID {formula_id} обновлена.")
@@ -134,6 +144,7 @@ def delete_formula(db: Session, formula_id):
         formula = db.query(Formula).filter_by(id=formula_id).first()
         if formula:
             db.delete(formula)
+            publish_change(db, "delete", formula.id)
             db.commit()
             print(f"Формула с ID {formula_id} удалена.")
             return True
@@ -155,3 +166,121 @@ def get_all_formulas(db: Session):
     except SQLAlchemyError as e:
         print(f"Ошибка при получении формул: {e}")
         return []
+
+def get_formulas_page(db: Session, offset=0, limit=None):
+    """
+    Возвращает формулы, упорядоченные по ID, начиная с позиции offset (не более limit штук).
+    """
+    try:
+        query = db.query(Formula).order_by(Formula.id).offset(offset)
+        if limit is not None:
+            query = query.limit(limit)
+        return query.all()
+    except SQLAlchemyError as e:
+        print(f"Ошибка при получении формул: {e}")
+        raise
+
+EXPORT_BATCH_SIZE = 500
+
+def iter_formulas_for_export(db: Session, ids=None, author_id=None, query=None, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Построчно выдаёт формулы для экспорта в виде словарей
+    {"id", "latex_formula", "legend", "description"}.
+    Читаются только нужные столбцы, пачками по batch_size строк.
+    ids - список ID (формулы выдаются в порядке списка, отсутствующие пропускаются);
+    иначе выбираются формулы по фильтру: author_id и/или подстрока query
+    в LaTeX, легенде или описании (без фильтров - весь каталог, по возрастанию ID).
+    """
+    columns = (Formula.id, Formula.latex_formula, Formula.legend, Formula.description)
+
+    def to_dict(row):
+        return {"id": row.id, "latex_formula": row.latex_formula,
+                "legend": row.legend, "description": row.description}
+
+    if ids is not None:
+        for start in range(0, len(ids), batch_size):
+            chunk = ids[start:start + batch_size]
+            rows = {row.id: row for row in db.query(*columns).filter(Formula.id.in_(chunk))}
+            for formula_id in chunk:
+                if formula_id in rows:
+                    yield to_dict(rows[formula_id])
+        return
+
+    base_query = db.query(*columns)
+    if author_id is not None:
+        base_query = base_query.filter(Formula.author_id == author_id)
+    if query:
+        pattern = f"%{query}%"
+        base_query = base_query.filter(or_(Formula.latex_formula.ilike(pattern),
+                                           Formula.legend.ilike(pattern),
+                                           Formula.description.ilike(pattern)))
+    # Постраничное чтение по ключу: каждая пачка начинается после последнего прочитанного ID
+    last_id = None
+    while True:
+        batch_query = base_query if last_id is None else base_query.filter(Formula.id > last_id)
+        rows = batch_query.order_by(Formula.id).limit(batch_size).all()
+        for row in rows:
+            yield to_dict(row)
+        if len(rows) < batch_size:
+            return
+        last_id = rows[-1].id
+
+def get_formula_latex(db: Session, formula_id):
+    """Возвращает LaTeX формулы по ID или None, если формулы нет."""
+    row = db.query(Formula.latex_formula).filter_by(id=formula_id).first()
+    return row[0] if row else None
+
+def _filter_shard(db: Session, query, shard_index, num_shards, strategy):
+    """
+    Ограничивает запрос формулами шарда shard_index из num_shards; возвращает None, если шард заведомо пуст.
+    strategy="hash"  - шард определяется остатком id по модулю num_shards;
+    strategy="range" - диапазон id [min_id, max_id] делится на num_shards равных частей.
+    """
+    if strategy == "hash":
+        return query.filter(Formula.id % num_shards == shard_index)
+    if strategy == "range":
+        min_id, max_id = db.query(func.min(Formula.id), func.max(Formula.id)).one()
+        if min_id is None:
+            return None
+        span = (max_id - min_id) // num_shards + 1
+        lower = min_id + shard_index * span
+        return query.filter(Formula.id >= lower, Formula.id < lower + span)
+    raise ValueError(f"Неизвестная стратегия шардирования: {strategy}")
+
+SOURCE_BATCH_SIZE = 1000
+
+def iter_formula_sources(db: Session, shard_index=None, num_shards=None, strategy="hash",
+                         batch_size=SOURCE_BATCH_SIZE):
+    """
+    Построчно выдаёт пары (id, latex_formula) всех формул (или шарда, если задан shard_index)
+    по возрастанию ID. Читаются только эти два столбца, без объектов Formula,
+    строки приходят из базы пачками по batch_size.
+    Строки поддерживают доступ по именам: row.id, row.latex_formula.
+    """
+    query = db.query(Formula.id, Formula.latex_formula)
+    if shard_index is not None:
+        query = _filter_shard(db, query, shard_index, num_shards, strategy)
+        if query is None:
+            return
+    yield from query.order_by(Formula.id).yield_per(batch_size)
+
+def get_formulas_by_ids(db: Session, ids):
+    """
+    Возвращает полные строки формул с заданными ID в виде словаря {id: Formula}.
+    Отсутствующие ID пропускаются.
+    """
+    formulas = {}
+    ids = list(ids)
+    for start in range(0, len(ids), EXPORT_BATCH_SIZE):
+        chunk = ids[start:start + EXPORT_BATCH_SIZE]
+        for formula in db.query(Formula).filter(Formula.id.in_(chunk)):
+            formulas[formula.id] = formula
+    return formulas
+
+def get_catalogue_version(db: Session):
+    """
+    Возвращает версию каталога - пару (число формул, время последнего изменения).
+    Версия меняется при любом создании, обновлении или удалении формулы.
+    """
+    count, last_update = db.query(func.count(Formula.id), func.max(Formula.update_date)).one()
+    return count, last_update.isoformat() if last_update else None
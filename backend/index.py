@@ -1,7 +1,10 @@
 # index.py
+import hashlib
+
 import sympy
-from sympy import simplify, Symbol, Add, Mul
-from sympy.parsing.latex import parse_latex
+from sympy import simplify, Symbol, Add, Mul, Pow
+from latex_parser import parse_latex_fast
+from latex_spans import latex_with_spans
 from sympy.core.relational import Relational
 
 def replace_symbols_with_assumptions(expr, assumptions):
@@ -40,24 +43,59 @@ def expr_size(expr):
 def canonical_form(expr):
     """
     Приводит выражение к канонической форме:
-    - Раскрываем выражение (expand)
+    - Раскрываем выражение (expand): для всего дерева один раз, а для поддеревьев,
+      где expand не идемпотентен (см. _reexpands), - на каждом уровне, как раньше
     - Для сложений (Add) и умножений (Mul) сортируем аргументы по srepr()
     """
-    expr = sympy.expand(expr)
+    return _canonical_node(sympy.expand(expr), {}, {})
+
+def _reexpands(expr, cache):
+    """
+    Может ли повторный expand изменить уже раскрытое поддерево. Так бывает, если в нём
+    есть степени с символьным показателем ((exp(x)*exp(pi))**y раскрывается дальше
+    при повторном вызове) или экспоненты (аргумент exp раскрывается в сумму не за один вызов).
+    """
+    result = cache.get(expr)
+    if result is None:
+        result = (isinstance(expr, sympy.exp) or (isinstance(expr, Pow) and not expr.exp.is_Number)
+                  or any(_reexpands(arg, cache) for arg in expr.args))
+        cache[expr] = result
+    return result
+
+def _canonical_node(expr, sort_keys, reexpands, top=True):
+    """
+    Один проход снизу вверх по уже раскрытому выражению.
+    Поддеревья, для которых expand не идемпотентен, раскрываются заново на каждом уровне -
+    так результат совпадает с прежней реализацией (expand на каждом уровне рекурсии).
+    sort_keys - кеш srepr() уже канонизированных подвыражений, reexpands - кеш _reexpands.
+    """
     if expr.is_Atom:
         return expr
+    if not top and _reexpands(expr, reexpands):
+        expr = sympy.expand(expr)
+        if expr.is_Atom:
+            return expr
     # Применяем рекурсивно канонизацию к аргументам
-    new_args = [canonical_form(a) for a in expr.args]
+    new_args = [_canonical_node(a, sort_keys, reexpands, top=False) for a in expr.args]
     if isinstance(expr, Add) or isinstance(expr, Mul):
         # Сортируем аргументы
-        new_args.sort(key=lambda x: sympy.srepr(x))
+        new_args.sort(key=lambda x: _sort_key(x, sort_keys))
         if isinstance(expr, Add):
             return Add(*new_args, evaluate=False)
         else:
             return Mul(*new_args, evaluate=False)
-    else:
-        # Другие типы (Pow, Function etc.) просто пересобираем с канонизированными аргументами
-        return type(expr)(*new_args)
+    if all(new is old for new, old in zip(new_args, expr.args)):
+        # Аргументы не изменились - пересборка (и повторное вычисление) узла не нужна
+        return expr
+    # Другие типы (Pow, Function etc.) пересобираем с канонизированными аргументами
+    return type(expr)(*new_args)
+
+def _sort_key(expr, sort_keys):
+    key = sort_keys.get(expr)
+    if key is None:
+        key = sympy.srepr(expr)
+        sort_keys[expr] = key
+    return key
 
 def subexpressions(expr):
     subs = set()
@@ -137,35 +175,115 @@ def canonicalize_variables(expr1, expr2):
         # Различное количество переменных. Просто вернём как есть.
         return expr1, expr2, False
 
-def compare_formulas_sympy(formula1: str, formula2: str, assumptions=None):
+def rename_variables(expr):
     """
-    Сравнивает две формулы, используя:
-    - Канонизацию имён переменных
-    - Приведение к канонической форме (сортировка аргументов в Add/Mul)
-    - Поиск наибольшего общего подвыражения (НОП)
+    Переименовывает переменные выражения в x_1, x_2, ... (в порядке сортировки имён)
+    и упрощает результат - так же, как canonicalize_variables для пары выражений
+    с одинаковым числом переменных.
+    """
+    variables = sorted(expr.free_symbols, key=lambda x: x.name)
+    mapping = {v: Symbol(f"x_{i}") for i, v in enumerate(variables, 1)}
+    return simplify(expr.subs(mapping)), len(variables)
+
+FINGERPRINT_POINTS = (
+    (0.5772156649, 1.4142135623, 2.7182818284, 0.3183098861, 1.6180339887, 0.6931471805),
+    (1.3247179572, 0.7071067811, 1.1447298858, 2.2360679774, 0.4342944819, 1.7320508075),
+)
+
+def numeric_fingerprint(expr):
+    """
+    Вычисляет значения выражения (с переменными x_1, x_2, ...) в фиксированных точках.
+    Эквивалентные выражения имеют одинаковый отпечаток, поэтому он годится
+    как быстрый предварительный фильтр перед символьным сравнением.
+    Возвращает None, если выражение не удаётся вычислить численно
+    (в том числе для логических значений: уравнение x = x упрощается до True).
+    """
+    if not isinstance(expr, sympy.Expr):
+        return None
+    variables = sorted(expr.free_symbols, key=lambda x: x.name)
+    if any(len(variables) > len(point) for point in FINGERPRINT_POINTS):
+        return None
+    fingerprint = []
+    try:
+        for point in FINGERPRINT_POINTS:
+            value = complex(expr.evalf(12, subs=dict(zip(variables, point))))
+            if value != value or abs(value) == float("inf"):
+                return None
+            fingerprint.append((round(value.real, 8), round(value.imag, 8)))
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+    return tuple(fingerprint)
+
+def subtree_hashes(expr):
+    """Возвращает отсортированный список 64-битных хешей srepr всех подвыражений."""
+    hashes = set()
+    for sub in sympy.preorder_traversal(expr):
+        digest = hashlib.blake2b(sympy.srepr(sub).encode("utf-8"), digest_size=8).digest()
+        hashes.add(int.from_bytes(digest, "little"))
+    return sorted(hashes)
+
+class PreparedFormula:
+    """
+    Результат обработки одной формулы, не зависящий от формулы, с которой её сравнивают:
+    - canonical_renamed - каноническая форма после переименования переменных в x_1, x_2, ...
+      (используется, если у сравниваемых формул одинаковое число переменных)
+    - canonical_plain   - каноническая форма с исходными именами переменных
+    - num_vars          - число свободных переменных
+    - size, hashes, fingerprint - размер, хеши поддеревьев и числовой отпечаток canonical_renamed
+    """
+    __slots__ = ("latex", "canonical_renamed", "canonical_plain", "num_vars",
+                 "size", "hashes", "fingerprint")
+
+    def __init__(self, latex, canonical_renamed, canonical_plain, num_vars,
+                 size=None, hashes=None, fingerprint=None):
+        self.latex = latex
+        self.canonical_renamed = canonical_renamed
+        self.canonical_plain = canonical_plain
+        self.num_vars = num_vars
+        self.size = expr_size(canonical_renamed) if size is None else size
+        self.hashes = subtree_hashes(canonical_renamed) if hashes is None else hashes
+        self.fingerprint = numeric_fingerprint(canonical_renamed) if fingerprint is None else fingerprint
+
+def prepare_formula(formula: str, assumptions=None):
+    """
+    Парсит формулу и выполняет все шаги compare_formulas_sympy,
+    которые зависят только от неё самой (упрощение, канонизация).
     """
     try:
-        expr1 = parse_latex(formula1)
-        expr2 = parse_latex(formula2)
+        expr = parse_latex_fast(formula)
     except Exception as e:
         raise ValueError(f"Ошибка при парсинге формул: {e}")
 
-    expr1 = canonicalize_equation(expr1)
-    expr2 = canonicalize_equation(expr2)
-
-    expr1 = replace_symbols_with_assumptions(expr1, assumptions)
-    expr2 = replace_symbols_with_assumptions(expr2, assumptions)
+    expr = canonicalize_equation(expr)
+    expr = replace_symbols_with_assumptions(expr, assumptions)
 
     # Упрощаем
-    expr1_simpl = simplify(expr1)
-    expr2_simpl = simplify(expr2)
+    expr_simpl = simplify(expr)
 
     # Канонизация переменных
-    expr1_canon, expr2_canon, can_compare = canonicalize_variables(expr1_simpl, expr2_simpl)
+    expr_renamed, num_vars = rename_variables(expr_simpl)
 
     # Приводим к канонической форме (упорядочиваем слагаемые и множители)
-    expr1_canon = canonical_form(expr1_canon)
-    expr2_canon = canonical_form(expr2_canon)
+    return PreparedFormula(
+        latex=formula,
+        canonical_renamed=canonical_form(expr_renamed),
+        canonical_plain=canonical_form(expr_simpl),
+        num_vars=num_vars,
+    )
+
+def compare_prepared(prepared1: PreparedFormula, prepared2: PreparedFormula, with_latex=False):
+    """
+    Сравнивает две подготовленные формулы (см. prepare_formula).
+    Возвращает то же, что и compare_formulas_sympy; при with_latex=True в конец
+    кортежа добавляется LaTeX simplified2, уже напечатанный для поиска вхождений.
+    """
+    can_compare = prepared1.num_vars == prepared2.num_vars
+    if can_compare:
+        expr1_canon = prepared1.canonical_renamed
+        expr2_canon = prepared2.canonical_renamed
+    else:
+        expr1_canon = prepared1.canonical_plain
+        expr2_canon = prepared2.canonical_plain
 
     if can_compare and expr1_canon.equals(expr2_canon):
         equivalent = True
@@ -187,25 +305,49 @@ def compare_formulas_sympy(formula1: str, formula2: str, assumptions=None):
     subexprs1, subexprs_dict1, index_map1 = get_subexpressions_with_index(simplified1)
     subexprs2, subexprs_dict2, index_map2 = get_subexpressions_with_index(simplified2)
     intersection = subexprs1.intersection(subexprs2)
-    latex_simplified2 = sympy.latex(simplified2)
+    # simplified2 печатается один раз с картой позиций подвыражений;
+    # если подвыражение не получило своего участка (например, печатается как "-" + терм),
+    # его вхождения ищутся подстрокой, как раньше
+    printed = latex_with_spans(simplified2) if intersection else None
+    if printed is not None:
+        latex_simplified2, spans2 = printed
+    else:
+        latex_simplified2, spans2 = sympy.latex(simplified2), {}
 
     common_subexpressions = []
     common_indices_in_expr2 = {}
     substring_occurrences_in_simplified2 = {}
 
     for s in intersection:
-        sub_expr = subexprs_dict1[s]
-        l_sub = sympy.latex(sub_expr)
-        common_subexpressions.append(l_sub)
         indices = index_map2[s]
+        occ = spans2.get(subexprs_dict2[s])
+        if occ:
+            start, length = occ[0]
+            l_sub = latex_simplified2[start:start + length]
+        else:
+            l_sub = sympy.latex(subexprs_dict1[s])
+            occ = find_all_occurrences(latex_simplified2, l_sub)
+        common_subexpressions.append(l_sub)
         common_indices_in_expr2[l_sub] = indices
-        occ = find_all_occurrences(latex_simplified2, l_sub)
         substring_occurrences_in_simplified2[l_sub] = occ
 
-    return (equivalent,
-            similarity,
-            common_subexpressions,
-            common_indices_in_expr2,
-            substring_occurrences_in_simplified2,
-            simplified1,
-            simplified2)
+    result = (equivalent,
+              similarity,
+              common_subexpressions,
+              common_indices_in_expr2,
+              substring_occurrences_in_simplified2,
+              simplified1,
+              simplified2)
+    if with_latex:
+        return result + (latex_simplified2,)
+    return result
+
+def compare_formulas_sympy(formula1: str, formula2: str, assumptions=None):
+    """
+    Сравнивает две формулы, используя:
+    - Канонизацию имён переменных
+    - Приведение к канонической форме (сортировка аргументов в Add/Mul)
+    - Поиск наибольшего общего подвыражения (НОП)
+    """
+    return compare_prepared(prepare_formula(formula1, assumptions),
+                            prepare_formula(formula2, assumptions))
@@ -6,9 +6,24 @@ from docx.oxml.ns import qn
 from docx.oxml import OxmlElement
 from matplotlib import pyplot as plt
 from matplotlib import rc
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.figure import Figure
+from matplotlib.font_manager import FontProperties
+from matplotlib.patches import PathPatch
+from matplotlib.textpath import TextPath, TextToPath
+from matplotlib.transforms import Affine2D
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import os
+import shutil
+import tempfile
 import uuid
 
+try:
+    from pypdf import PdfWriter
+except ImportError:
+    PdfWriter = None
+
 def add_page_number(paragraph):
     """Добавляет номер страницы в нижний колонтитул."""
     run = paragraph.add_run()
@@ -86,7 +101,11 @@ def create_custom_styles(document):
     font.color.rgb = RGBColor(0, 0, 0)
 
 def json_to_docx(json_data, output_directory):
-    """Преобразует JSON-данные в стильный docx-файл."""
+    """
+    Преобразует JSON-данные в стильный docx-файл.
+    json_data - любой итерируемый набор словарей с полями latex_formula, legend, description
+    (например, генератор строк из базы): формулы добавляются по мере чтения.
+    """
     file_name = f"mathematical_formulas_{uuid.uuid4().hex[:8]}.docx"
     output_file = os.path.join(output_directory, file_name)
 
@@ -111,6 +130,14 @@ def json_to_docx(json_data, output_directory):
     document.add_paragraph()  # Пустая строка после заголовка
 
     for i, item in enumerate(json_data, 1):
+        # Добавление разделителя перед каждой формулой, кроме первой
+        if i > 1:
+            document.add_paragraph()
+            separator = document.add_paragraph()
+            separator.alignment = WD_ALIGN_PARAGRAPH.CENTER
+            separator.add_run('⚡').font.size = Pt(14)
+            document.add_paragraph()
+
         formula = item.get("latex_formula", "")
         legend = item.get("legend", f"Формула {i}")
         description = item.get("description", "")
@@ -136,23 +163,227 @@ def json_to_docx(json_data, output_directory):
             desc_paragraph.add_run(description)
             desc_paragraph.alignment = WD_ALIGN_PARAGRAPH.JUSTIFY
 
-        # Добавление разделителя (кроме последней формулы)
-        if i < len(json_data):
-            document.add_paragraph()
-            separator = document.add_paragraph()
-            separator.alignment = WD_ALIGN_PARAGRAPH.CENTER
-            separator.add_run('⚡').font.size = Pt(14)
-            document.add_paragraph()
-        
-        # Добавление номера страницы
-        footer = document.sections[0].footer
-        footer_paragraph = footer.paragraphs[0]
-        footer_paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
-        add_page_number(footer_paragraph)
+    # Добавление номера страницы
+    footer = document.sections[0].footer
+    footer_paragraph = footer.paragraphs[0]
+    footer_paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    add_page_number(footer_paragraph)
 
     document.save(output_file)
     return output_file
 
+# --- Экспорт в PDF ---
+# Формулы рисуются векторными контурами глифов (mathtext -> TextPath), без растровых картинок.
+# Сначала последовательно рассчитывается раскладка всех страниц, затем страницы
+# рисуются пачками в параллельных процессах и склеиваются в один PDF.
+
+PAGE_WIDTH = 595.28   # A4, пункты
+PAGE_HEIGHT = 841.89
+PAGE_MARGIN = 72.0
+CONTENT_WIDTH = PAGE_WIDTH - 2 * PAGE_MARGIN
+
+PDF_TITLE_SIZE = 24
+PDF_FORMULA_TITLE_SIZE = 16
+PDF_FORMULA_SIZE = 20
+PDF_DESCRIPTION_SIZE = 11
+PDF_LINE_SPACING = 1.35
+PDF_BLOCK_GAP = 14.0
+PDF_SEPARATOR_HEIGHT = 36.0
+
+TITLE_COLOR = (0, 32 / 255, 96 / 255)
+FORMULA_TITLE_COLOR = (47 / 255, 84 / 255, 150 / 255)
+FORMULA_COLOR = "navy"
+# Текст вместо пустой формулы
+PDF_EMPTY_FORMULA = "(пустая формула)"
+
+# Размер шрифта, в котором измеряются ширины символов
+PDF_MEASURE_SIZE = 100
+# Страниц в одной пачке, рисуемой отдельным процессом
+PDF_PAGES_PER_CHUNK = 20
+
+_text_to_path = TextToPath()
+_char_widths = {}
+
+
+def _text_width(text, size):
+    """
+    Ширина строки в пунктах как сумма ширин символов (без кернинга).
+    Ширины символов кешируются: измерение целой строки через FreeType заметно медленнее.
+    """
+    width = 0.0
+    for char in text:
+        char_width = _char_widths.get(char)
+        if char_width is None:
+            char_width, _, _ = _text_to_path.get_text_width_height_descent(
+                char, FontProperties(size=PDF_MEASURE_SIZE), ismath=False)
+            _char_widths[char] = char_width
+        width += char_width
+    return width * size / PDF_MEASURE_SIZE
+
+
+def wrap_text(text, size, width):
+    """Переносит текст по словам так, чтобы строки помещались в width пунктов."""
+    lines = []
+    for paragraph in text.splitlines() or [""]:
+        line = ""
+        for word in paragraph.split():
+            candidate = f"{line} {word}" if line else word
+            if line and _text_width(candidate, size) > width:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+        lines.append(line)
+    return lines
+
+
+def formula_path(latex_code, size=PDF_FORMULA_SIZE):
+    """
+    Возвращает векторный контур формулы (TextPath) и его габариты (ширина, высота, нижний край).
+    Если mathtext не понимает формулу или она не содержит ни одного глифа (например, "\\,"),
+    контуром становится исходная LaTeX-строка, а для пустой формулы - заглушка.
+    """
+    text = latex_code.strip()
+    path = None
+    if text:
+        try:
+            path = TextPath((0, 0), f"${latex_code}$", prop=FontProperties(size=size))
+        except (ValueError, AttributeError):
+            # ValueError - mathtext не разобрал формулу, AttributeError - в ней нет ни одного глифа
+            pass
+    if path is None:
+        path = TextPath((0, 0), text or PDF_EMPTY_FORMULA, prop=FontProperties(size=size * 0.7, family="monospace"))
+    extents = path.get_extents()
+    return path, extents.width, extents.height, extents.y0, extents.x0
+
+
+def layout_pdf(json_data):
+    """
+    Раскладывает формулы по страницам A4.
+    Возвращает список страниц; страница - список элементов (вид, y, данные),
+    где y - координата верхнего края элемента в пунктах от низа страницы.
+    """
+    pages = [[("title", PAGE_HEIGHT - PAGE_MARGIN, "Математические формулы")]]
+    y = PAGE_HEIGHT - PAGE_MARGIN - PDF_TITLE_SIZE * PDF_LINE_SPACING - PDF_BLOCK_GAP
+    bottom = PAGE_MARGIN + PDF_DESCRIPTION_SIZE * 2
+
+    def place(height):
+        nonlocal y
+        if y - height < bottom and pages[-1]:
+            pages.append([])
+            y = PAGE_HEIGHT - PAGE_MARGIN
+        top = y
+        y -= height
+        return top
+
+    for i, item in enumerate(json_data, 1):
+        formula = item.get("latex_formula", "") or ""
+        legend = item.get("legend") or f"Формула {i}"
+        description = item.get("description", "") or ""
+
+        if i > 1:
+            top = place(PDF_SEPARATOR_HEIGHT)
+            pages[-1].append(("separator", top, None))
+
+        path, width, height, y0, x0 = formula_path(formula)
+        scale = min(1.0, CONTENT_WIDTH / width) if width else 1.0
+        title_height = PDF_FORMULA_TITLE_SIZE * PDF_LINE_SPACING
+        formula_height = height * scale + PDF_BLOCK_GAP
+        # Заголовок не отрывается от формулы
+        top = place(title_height + formula_height)
+        pages[-1].append(("formula_title", top, f"Формула {i}: {legend}"))
+        pages[-1].append(("formula", top - title_height, (path, scale, width, height, y0, x0)))
+
+        if description:
+            line_height = PDF_DESCRIPTION_SIZE * PDF_LINE_SPACING
+            for line in wrap_text(description, PDF_DESCRIPTION_SIZE, CONTENT_WIDTH):
+                top = place(line_height)
+                pages[-1].append(("description", top, line))
+        y -= PDF_BLOCK_GAP
+    return pages
+
+
+def _draw_page(figure, elements, page_number, page_count):
+    # Текст (заголовки, легенды, описания) выводится как есть: "$" в нём - не разметка mathtext
+    points = Affine2D().scale(1 / 72) + figure.dpi_scale_trans
+    for kind, top, data in elements:
+        if kind == "title":
+            figure.text(0.5, (top - PDF_TITLE_SIZE) / PAGE_HEIGHT, data, ha="center", va="baseline",
+                        fontsize=PDF_TITLE_SIZE, fontweight="bold", color=TITLE_COLOR, parse_math=False)
+        elif kind == "formula_title":
+            figure.text(PAGE_MARGIN / PAGE_WIDTH, (top - PDF_FORMULA_TITLE_SIZE) / PAGE_HEIGHT, data,
+                        ha="left", va="baseline", fontsize=PDF_FORMULA_TITLE_SIZE, fontweight="bold",
+                        color=FORMULA_TITLE_COLOR, parse_math=False)
+        elif kind == "formula":
+            path, scale, width, height, y0, x0 = data
+            x = PAGE_MARGIN + (CONTENT_WIDTH - width * scale) / 2 - x0 * scale
+            y = top - PDF_BLOCK_GAP / 2 - (height + y0) * scale
+            transform = Affine2D().scale(scale).translate(x, y) + points
+            figure.patches.append(PathPatch(path, transform=transform, facecolor=FORMULA_COLOR,
+                                            edgecolor="none", figure=figure))
+        elif kind == "description":
+            figure.text(PAGE_MARGIN / PAGE_WIDTH, (top - PDF_DESCRIPTION_SIZE) / PAGE_HEIGHT, data,
+                        ha="left", va="baseline", fontsize=PDF_DESCRIPTION_SIZE, color="black",
+                        parse_math=False)
+        elif kind == "separator":
+            figure.text(0.5, (top - PDF_SEPARATOR_HEIGHT / 2) / PAGE_HEIGHT, "\u2014 \u2022 \u2014",
+                        ha="center", va="center", fontsize=14, color=FORMULA_TITLE_COLOR)
+    figure.text(0.5, (PAGE_MARGIN / 2) / PAGE_HEIGHT, f"{page_number} / {page_count}",
+                ha="center", va="center", fontsize=10, color="black")
+
+
+def render_pdf_pages(pages, first_page_number, page_count, output_file):
+    """Рисует страницы в PDF-файл; номера страниц начинаются с first_page_number."""
+    with PdfPages(output_file) as pdf:
+        for offset, elements in enumerate(pages):
+            figure = Figure(figsize=(PAGE_WIDTH / 72, PAGE_HEIGHT / 72))
+            _draw_page(figure, elements, first_page_number + offset, page_count)
+            pdf.savefig(figure)
+    return output_file
+
+
+def json_to_pdf(json_data, output_directory, workers=None, pages_per_chunk=PDF_PAGES_PER_CHUNK):
+    """
+    Преобразует JSON-данные (итерируемый набор словарей, как для json_to_docx) в PDF
+    с векторными формулами. Большие документы рисуются пачками страниц в нескольких
+    процессах (workers, по умолчанию - число ядер) и склеиваются через pypdf;
+    без pypdf документ рисуется в одном процессе.
+    """
+    file_name = f"mathematical_formulas_{uuid.uuid4().hex[:8]}.pdf"
+    output_file = os.path.join(output_directory, file_name)
+    os.makedirs(output_directory, exist_ok=True)
+
+    pages = layout_pdf(json_data)
+    chunks = [pages[start:start + pages_per_chunk] for start in range(0, len(pages), pages_per_chunk)]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = min(workers, len(chunks))
+    if workers <= 1 or PdfWriter is None:
+        return render_pdf_pages(pages, 1, len(pages), output_file)
+
+    chunk_directory = tempfile.mkdtemp(prefix="pdf_chunks_", dir=output_directory)
+    try:
+        # spawn: экспорт вызывается из потоков веб-сервера, fork процесса с потоками небезопасен
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            futures = []
+            first_page_number = 1
+            for index, chunk in enumerate(chunks):
+                chunk_file = os.path.join(chunk_directory, f"chunk_{index:05d}.pdf")
+                futures.append(pool.submit(render_pdf_pages, chunk, first_page_number, len(pages), chunk_file))
+                first_page_number += len(chunk)
+            chunk_files = [future.result() for future in futures]
+
+        writer = PdfWriter()
+        for chunk_file in chunk_files:
+            writer.append(chunk_file)
+        with open(output_file, "wb") as f:
+            writer.write(f)
+        return output_file
+    finally:
+        shutil.rmtree(chunk_directory, ignore_errors=True)
+
+
 # Пример использования
 if __name__ == "__main__":
     json_data = [
@@ -170,4 +401,6 @@ if __name__ == "__main__":
 
     output_dir = "output_docs"
     output_file = json_to_docx(json_data, output_dir)
+    print(f"Документ успешно сохранен: {output_file}")
+    output_file = json_to_pdf(json_data, output_dir)
     print(f"Документ успешно сохранен: {output_file}")
\ No newline at end of file
@@ -0,0 +1,424 @@
+# latex_parser.py
+"""
+Быстрый парсер LaTeX -> SymPy для подмножества, которое выдаёт редактор формул
+(см. ast_to_latex в converter.py): числа, переменные с индексами, греческие буквы,
++, -, =, \\cdot, \\times, /, ^, \\frac, \\sqrt, скобки и именованные функции.
+
+Выражения SymPy строятся напрямую, без ANTLR, теми же конструкторами
+(без вычисления), что и в sympy.parsing.latex.parse_latex, поэтому результат
+совпадает с ним, включая особенности:
+    - f(x) для одиночной буквы перед скобкой - неопределённая функция;
+    - аргумент функции без круглых скобок захватывает всё произведение:
+      \\sin{x} y -> sin(x*y), \\sin{x}^2 -> sin(x**2), но \\sin{x} \\cos{x} -> sin(x)*cos(x).
+Всё, что не входит в подмножество, передаётся в parse_latex (parse_latex_fast).
+
+Соответствие parse_latex проверяется на корпусе CONFORMANCE_CORPUS:
+    python benchmarks.py parser
+"""
+import re
+
+import sympy
+from sympy.parsing.latex import parse_latex
+
+
+class UnsupportedLatex(ValueError):
+    """Конструкция не входит в поддерживаемое подмножество LaTeX."""
+
+
+TOKEN_RE = re.compile(r"\s+|\\[a-zA-Z]+|\\[,;:! ]|\d+(?:\.\d+)?|[a-zA-Z]|\S")
+
+SPACING_COMMANDS = {"\\,", "\\;", "\\:", "\\!", "\\ ", "\\quad", "\\qquad"}
+
+MUL_COMMANDS = {"\\cdot", "\\times"}
+
+X_SYMBOL = sympy.Symbol("x")
+
+GREEK_LETTERS = {
+    "alpha", "beta", "gamma", "delta", "epsilon", "varepsilon", "zeta", "eta", "theta",
+    "vartheta", "iota", "kappa", "lambda", "mu", "nu", "xi", "pi", "rho", "sigma", "tau",
+    "upsilon", "phi", "varphi", "chi", "psi", "omega",
+    "Gamma", "Delta", "Theta", "Lambda", "Xi", "Pi", "Sigma", "Upsilon", "Phi", "Psi", "Omega",
+}
+
+FUNCTIONS = {
+    "sin": sympy.sin, "cos": sympy.cos, "tan": sympy.tan,
+    "cot": sympy.cot, "sec": sympy.sec, "csc": sympy.csc,
+    "arcsin": sympy.asin, "arccos": sympy.acos, "arctan": sympy.atan,
+    "sinh": sympy.sinh, "cosh": sympy.cosh, "tanh": sympy.tanh,
+    "exp": sympy.exp, "ln": sympy.log, "log": sympy.log,
+}
+
+
+def tokenize(latex):
+    tokens = []
+    for match in TOKEN_RE.finditer(latex):
+        token = match.group()
+        if token.isspace() or token in SPACING_COMMANDS:
+            continue
+        tokens.append(token)
+    return tokens
+
+
+def is_number(token):
+    return token[0].isdigit()
+
+
+def is_letter(token):
+    return len(token) == 1 and token.isalpha()
+
+
+def command_name(token):
+    return token[1:] if token.startswith("\\") else None
+
+
+class _Parser:
+    def __init__(self, latex):
+        self.tokens = tokenize(latex)
+        self.position = 0
+
+    def peek(self, offset=0):
+        index = self.position + offset
+        return self.tokens[index] if index < len(self.tokens) else None
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            raise UnsupportedLatex("Неожиданный конец формулы")
+        self.position += 1
+        return token
+
+    def expect(self, token):
+        actual = self.next()
+        if actual != token:
+            raise UnsupportedLatex(f"Ожидалось {token!r}, получено {actual!r}")
+
+    def parse(self):
+        lhs = self.parse_expression()
+        if self.peek() == "=":
+            self.next()
+            rhs = self.parse_expression()
+            result = sympy.Eq(lhs, rhs)
+        else:
+            result = lhs
+        if self.peek() is not None:
+            raise UnsupportedLatex(f"Неподдерживаемый токен {self.peek()!r}")
+        return result
+
+    def parse_expression(self):
+        left = self.parse_term()
+        while self.peek() in ("+", "-"):
+            op = self.next()
+            right = self.parse_term()
+            if op == "+":
+                left = sympy.Add(left, right, evaluate=False)
+            elif right.is_Atom:
+                left = sympy.Add(left, -1 * right, evaluate=False)
+            else:
+                left = sympy.Add(left, sympy.Mul(-1, right, evaluate=False), evaluate=False)
+        return left
+
+    def parse_term(self, allow_functions=True):
+        left = self.parse_unary(allow_functions)
+        while True:
+            token = self.peek()
+            if token in MUL_COMMANDS:
+                self.next()
+                left = sympy.Mul(left, self.parse_unary(allow_functions), evaluate=False)
+            elif token == "/":
+                self.next()
+                right = self.parse_unary(allow_functions)
+                left = sympy.Mul(left, sympy.Pow(right, -1, evaluate=False), evaluate=False)
+            else:
+                return left
+
+    def parse_unary(self, allow_functions=True):
+        token = self.peek()
+        if token == "-":
+            self.next()
+            return -self.parse_unary(allow_functions)
+        if token == "+":
+            self.next()
+            return self.parse_unary(allow_functions)
+
+        # Неявное умножение: 2x, mc^2, (a+b)c
+        factors = [self.parse_postfix()]
+        while self.starts_factor(self.peek(), allow_functions):
+            if is_number(self.peek()) and is_number(self.tokens[self.position - 1]):
+                # parse_latex склеивает соседние числа ("2 3" -> 23)
+                raise UnsupportedLatex("Два числа подряд")
+            factors.append(self.parse_postfix())
+        for i in range(1, len(factors) - 1):
+            # parse_latex читает x между двумя числами как знак умножения ("2 x 3")
+            if factors[i] == X_SYMBOL and not (factors[i - 1].free_symbols or factors[i + 1].free_symbols):
+                raise UnsupportedLatex("x как знак умножения")
+        result = factors[-1]
+        for factor in reversed(factors[:-1]):
+            result = sympy.Mul(factor, result, evaluate=False)
+        return result
+
+    def parse_postfix(self):
+        base = self.parse_atom()
+        while self.peek() == "^":
+            self.next()
+            base = sympy.Pow(base, self.parse_exponent(), evaluate=False)
+        if self.peek() in ("_", "!", "'"):
+            raise UnsupportedLatex(f"Неподдерживаемый токен {self.peek()!r}")
+        return base
+
+    def parse_exponent(self):
+        token = self.peek()
+        if token == "{":
+            return self.parse_group()
+        if token is not None and (is_number(token) or is_letter(token) or command_name(token) in GREEK_LETTERS):
+            return self.parse_atom()
+        raise UnsupportedLatex(f"Неподдерживаемая степень {token!r}")
+
+    def starts_factor(self, token, allow_functions=True):
+        if token is None:
+            return False
+        if is_number(token) or is_letter(token) or token in ("(", "{", "\\left"):
+            return True
+        name = command_name(token)
+        if name in FUNCTIONS or name == "sqrt":
+            return allow_functions
+        return name in GREEK_LETTERS or name in ("frac", "infty")
+
+    def parse_group(self):
+        self.expect("{")
+        expr = self.parse_expression()
+        self.expect("}")
+        return expr
+
+    def at_paren(self):
+        return self.peek() == "(" or (self.peek() == "\\left" and self.peek(1) == "(")
+
+    def parse_paren(self):
+        if self.peek() == "\\left":
+            self.next()
+            self.expect("(")
+            expr = self.parse_expression()
+            self.expect("\\right")
+            self.expect(")")
+            return expr
+        self.expect("(")
+        expr = self.parse_expression()
+        self.expect(")")
+        return expr
+
+    def parse_subscript(self):
+        """Индекс переменной: x_1, x_{10}, x_a. Более сложные индексы не поддерживаются."""
+        self.expect("_")
+        if self.peek() == "{":
+            self.next()
+            token = self.next()
+            self.expect("}")
+        else:
+            token = self.next()
+            if is_number(token) and self.peek() is not None and is_number(self.peek()):
+                # parse_latex дописывает следующее число к индексу ("x_1 2" -> x_{12})
+                raise UnsupportedLatex("Число после индекса")
+        if not (is_letter(token) or (is_number(token) and token.isdigit())):
+            raise UnsupportedLatex(f"Неподдерживаемый индекс {token!r}")
+        return token
+
+    def parse_symbol(self, name):
+        if self.peek() == "_":
+            name = f"{name}_{{{self.parse_subscript()}}}"
+            if self.at_paren():
+                raise UnsupportedLatex("Функция с индексом")
+        return sympy.Symbol(name)
+
+    def parse_atom(self):
+        token = self.next()
+        if is_number(token):
+            return sympy.Number(token)
+        if is_letter(token):
+            if self.peek() != "_" and self.at_paren():
+                # Как и parse_latex, f(x) считается неопределённой функцией
+                return sympy.Function(token)(self.parse_paren())
+            return self.parse_symbol(token)
+        if token in ("(", "\\left"):
+            self.position -= 1
+            return self.parse_paren()
+        if token == "{":
+            self.position -= 1
+            return self.parse_group()
+
+        name = command_name(token)
+        if name == "frac":
+            numerator = self.parse_group()
+            inverse_denominator = sympy.Pow(self.parse_group(), -1, evaluate=False)
+            if numerator == 1:
+                return inverse_denominator
+            return sympy.Mul(numerator, inverse_denominator, evaluate=False)
+        if name == "sqrt":
+            if self.peek() == "[":
+                self.next()
+                index = self.parse_expression()
+                self.expect("]")
+                return sympy.root(self.parse_group(), index, evaluate=False)
+            return sympy.sqrt(self.parse_group(), evaluate=False)
+        if name == "infty":
+            return sympy.oo
+        if name in GREEK_LETTERS:
+            if self.at_paren():
+                raise UnsupportedLatex("Греческая буква перед скобкой")
+            return self.parse_symbol(name)
+        if name in FUNCTIONS:
+            return self.parse_function(name)
+        raise UnsupportedLatex(f"Неподдерживаемый токен {token!r}")
+
+    def parse_function(self, name):
+        base = None
+        if name == "log" and self.peek() == "_":
+            self.next()
+            base = self.parse_group() if self.peek() == "{" else self.parse_atom()
+        if self.peek() == "^":
+            raise UnsupportedLatex("Степень имени функции")
+        if self.at_paren():
+            argument = self.parse_paren()
+        else:
+            # Как и parse_latex, аргумент без круглых скобок захватывает произведение
+            # вплоть до следующей функции
+            argument = self.parse_term(allow_functions=False)
+        if name in ("log", "ln"):
+            return sympy.log(argument, sympy.E if base is None else base, evaluate=False)
+        return FUNCTIONS[name](argument, evaluate=False)
+
+
+def parse_latex_native(latex: str):
+    """
+    Разбирает формулу из поддерживаемого подмножества LaTeX.
+    Для остальных формул выбрасывает UnsupportedLatex.
+    """
+    if not latex or not latex.strip():
+        raise UnsupportedLatex("Пустая формула")
+    return _Parser(latex).parse()
+
+
+def parse_latex_fast(latex: str):
+    """
+    Разбирает формулу быстрым парсером, а если формула не входит
+    в поддерживаемое подмножество - через sympy parse_latex.
+    """
+    try:
+        return parse_latex_native(latex)
+    except (UnsupportedLatex, RecursionError):
+        return parse_latex(latex)
+
+
+# Корпус для проверки соответствия parse_latex: формулы, которые редактор
+# и пользователи реально вводят, и граничные случаи грамматики
+CONFORMANCE_CORPUS = [
+    "E = mc^2",
+    "F = ma",
+    "F = m a",
+    "p = mv",
+    "a^2 + b^2 = c^2",
+    "x^2 + 2x + 1",
+    "x^{2} + 2 \\cdot x + 1",
+    "\\frac{a}{b}",
+    "\\frac{1}{2} m v^2",
+    "\\frac{-b + \\sqrt{b^2 - 4 \\cdot a \\cdot c}}{2 \\cdot a}",
+    "x = \\frac{0 - b + \\sqrt{b^{2} - 4 \\cdot a \\cdot c}}{2 \\cdot a}",
+    "\\sqrt{x}",
+    "\\sqrt{x + 1}",
+    "\\sqrt[3]{x}",
+    "\\sqrt{x} \\sqrt{y}",
+    "(x + 1)^3",
+    "(a + b)(a - b)",
+    "(a + b) c",
+    "2(a + b)",
+    "a \\times b = c",
+    "a \\cdot b c",
+    "x \\cdot -y",
+    "a - b",
+    "a + -b",
+    "a - -b",
+    "-x^2",
+    "-2x",
+    "- 2",
+    "-\\frac{1}{2}",
+    "2.5 x",
+    "3.14 r^2",
+    "y = k x + b",
+    "x^{y^z}",
+    "x^y^z",
+    "x^23",
+    "x^{-1}",
+    "x^{-\\frac{1}{2}}",
+    "x^\\pi",
+    "x_1 + x_2",
+    "x_{10} \\cdot y_a",
+    "\\alpha_1 + \\beta",
+    "\\pi r^2",
+    "\\Delta x",
+    "e^{i \\pi} + 1",
+    "\\sin{x}",
+    "\\sin(x)",
+    "\\sin x",
+    "\\sin{x} y",
+    "\\sin{x}^2",
+    "\\sin(x)^2",
+    "\\sin(x) y",
+    "\\sin x + y",
+    "\\sin x \\cdot y",
+    "\\sin{x}/2",
+    "\\sin{x} \\cos{x}",
+    "\\sin x \\sqrt{y}",
+    "\\sin x \\frac{y}{2}",
+    "\\cos{2 x} y \\sin{y}",
+    "\\sin{x}^2 + \\cos{x}^2",
+    "\\frac{\\sin{x}}{x}",
+    "\\tan{x} = \\frac{\\sin{x}}{\\cos{x}}",
+    "\\exp{x}",
+    "\\ln{x} + \\log{y}",
+    "\\log_2{x}",
+    "\\log_{10}{x}",
+    "\\sinh{x} + \\cosh{x}",
+    "\\arcsin{x}",
+    "f(x)",
+    "f(x)^2",
+    "x y(z)",
+    "a\\left(b + c\\right)",
+    "\\left(x + 1\\right)^2",
+    "{a}",
+    "x\\,y",
+    "\\frac{x^2 - 1}{x - 1}",
+    "\\infty",
+    "x = x",
+    # Не входят в подмножество - должны уходить в parse_latex
+    "\\cos^2{x}",
+    "x!",
+    "|x|",
+    "x^-1",
+    "\\frac12",
+    "\\mathrm{d}x",
+    "a < b",
+]
+
+
+def check_conformance(corpus=CONFORMANCE_CORPUS):
+    """
+    Сравнивает быстрый парсер с parse_latex на корпусе: деревья выражений
+    (srepr) должны совпадать в точности. Возвращает список расхождений
+    (формула, результат parse_latex, результат быстрого парсера) и число формул,
+    разобранных быстрым парсером без обращения к parse_latex.
+    """
+    mismatches = []
+    native_count = 0
+    for latex in corpus:
+        try:
+            expected = sympy.srepr(parse_latex(latex))
+        except Exception as e:
+            expected = f"ошибка: {type(e).__name__}"
+        try:
+            actual = sympy.srepr(parse_latex_native(latex))
+            native_count += 1
+        except UnsupportedLatex:
+            continue
+        except Exception as e:
+            actual = f"ошибка: {type(e).__name__}"
+        if actual != expected:
+            mismatches.append((latex, expected, actual))
+    return mismatches, native_count
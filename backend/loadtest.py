@@ -0,0 +1,302 @@
+# loadtest.py
+"""
+Нагрузочное тестирование API.
+
+Поднимает приложение (uvicorn api:app) на отдельной базе - по умолчанию на временной
+SQLite, либо на любой базе из --database-url (например, на тестовом PostgreSQL), -
+заполняет её N формулами и нагружает смешанным потоком запросов от C одновременных
+клиентов. Для каждого эндпоинта считаются пропускная способность, задержки
+p50/p95/p99 и доля ошибок; отчёт выводится в JSON, чтобы сравнивать прогоны между собой.
+
+    python loadtest.py --formulas 500 --concurrency 16 --duration 60 \\
+        --mix find_similar=1,formulas=10,manage_formula=3,convert_to_docx=0.2 --output report.json
+
+С --url нагружается уже запущенный сервер (база не создаётся и не заполняется).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime
+
+import httpx
+
+from latex_parser import CONFORMANCE_CORPUS
+
+BACKEND_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_MIX = "find_similar=1,formulas=10,manage_formula=3,convert_to_docx=0.2"
+ENDPOINTS = ("find_similar", "formulas", "manage_formula", "convert_to_docx")
+SERVER_START_TIMEOUT = 60.0
+REQUEST_TIMEOUT = 120.0
+LOADTEST_AUTHOR_ID = 1
+
+
+def generate_formulas(count, seed=0):
+    """Формулы для заполнения базы: корпус парсера с разными коэффициентами и показателями."""
+    rng = random.Random(seed)
+    formulas = []
+    for i in range(count):
+        base = CONFORMANCE_CORPUS[i % len(CONFORMANCE_CORPUS)]
+        if i < len(CONFORMANCE_CORPUS):
+            formulas.append(base)
+        else:
+            formulas.append(f"{rng.randint(2, 9)} \\left({base}\\right) + x^{{{rng.randint(2, 5)}}}")
+    return formulas
+
+
+def seed_database(database_url, count):
+    """Создаёт таблицу и заполняет базу count формулами (если их там меньше)."""
+    os.environ["DATABASE_URL"] = database_url
+    from db import SessionLocal, Formula
+
+    db = SessionLocal()
+    try:
+        existing = db.query(Formula).count()
+        formulas = generate_formulas(count)[existing:]
+        db.add_all(
+            Formula(latex_formula=latex, author_id=LOADTEST_AUTHOR_ID, legend=f"Формула {existing + i + 1}",
+                    description="Формула для нагрузочного тестирования")
+            for i, latex in enumerate(formulas)
+        )
+        db.commit()
+        return existing + len(formulas)
+    finally:
+        db.close()
+
+
+def start_server(database_url, port, workers):
+    """Запускает uvicorn с API на заданной базе и ждёт, пока он начнёт отвечать."""
+    env = dict(os.environ, DATABASE_URL=database_url)
+    command = [sys.executable, "-m", "uvicorn", "api:app", "--host", "127.0.0.1", "--port", str(port),
+               "--workers", str(workers), "--log-level", "warning"]
+    # Вывод сервера (print и логи на каждый запрос) не смешивается с отчётом
+    process = subprocess.Popen(command, cwd=BACKEND_DIRECTORY, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Сервер завершился с кодом {process.returncode}")
+        try:
+            urllib.request.urlopen(f"{base_url}/formulas?limit=1", timeout=2).read()
+            return process, base_url
+        except OSError:
+            time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError("Сервер не запустился за отведённое время")
+
+
+def parse_mix(mix):
+    """Разбирает строку вида "find_similar=1,formulas=10" в словарь весов."""
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in ENDPOINTS:
+            raise ValueError(f"Неизвестный эндпоинт: {name}. Допустимые: {', '.join(ENDPOINTS)}")
+        weights[name] = float(weight or 1)
+    return {name: weight for name, weight in weights.items() if weight > 0}
+
+
+def percentile(sorted_values, fraction):
+    """Перцентиль по методу ближайшего ранга для отсортированного списка."""
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+def _mathtext_supported(latex):
+    from matplotlib.textpath import TextPath
+
+    try:
+        TextPath((0, 0), f"${latex}$")
+        return True
+    except ValueError:
+        return False
+
+
+class Workload:
+    """Построение запросов к эндпоинтам и учёт формул, созданных во время теста."""
+
+    def __init__(self, formulas, rng):
+        self.formulas = formulas
+        self.rng = rng
+        self.created_ids = []
+        self._updating = set()
+        # DOCX-экспорт не умеет формулы, которые не понимает mathtext: такие запросы дали бы ложные ошибки
+        self.docx_formulas = [latex for latex in formulas[:len(CONFORMANCE_CORPUS)] if _mathtext_supported(latex)]
+
+    async def find_similar(self, client):
+        return await client.post("/find_similar", json={"formula": self.rng.choice(self.formulas)})
+
+    async def formulas_list(self, client):
+        return await client.get("/formulas")
+
+    async def manage_formula(self, client):
+        action = self.rng.choices(("create", "update", "delete"), weights=(5, 3, 2))[0]
+        # Формула, которую сейчас обновляет другой клиент, не удаляется: иначе обновление получит 404
+        deletable = [formula_id for formula_id in self.created_ids if formula_id not in self._updating]
+        if (action == "update" and not self.created_ids) or (action == "delete" and not deletable):
+            action = "create"
+        payload = {"formula": self.rng.choice(self.formulas), "userid": LOADTEST_AUTHOR_ID, "action": action,
+                   "legend": "Формула нагрузочного теста", "description": "Создана нагрузочным тестом"}
+        if action == "create":
+            response = await client.post("/manage_formula", json=payload)
+            if response.status_code == 200:
+                self.created_ids.append(response.json()["formula_id"])
+            return response
+        # Изменяются и удаляются только формулы, созданные самим тестом
+        if action == "update":
+            formula_id = self.rng.choice(self.created_ids)
+            payload["formula_id"] = formula_id
+            self._updating.add(formula_id)
+            try:
+                return await client.post("/manage_formula", json=payload)
+            finally:
+                self._updating.discard(formula_id)
+        formula_id = self.rng.choice(deletable)
+        self.created_ids.remove(formula_id)
+        payload["formula_id"] = formula_id
+        return await client.post("/manage_formula", json=payload)
+
+    async def convert_to_docx(self, client):
+        items = [
+            {"id": i + 1, "latex_formula": latex, "author_id": LOADTEST_AUTHOR_ID, "legend": f"Формула {i + 1}",
+             "description": "Формула для нагрузочного тестирования", "creation_date": None, "update_date": None}
+            for i, latex in enumerate(self.rng.sample(self.docx_formulas, min(5, len(self.docx_formulas))))
+        ]
+        return await client.post("/convert_to_docx", json=items)
+
+
+async def run_load(base_url, weights, concurrency, duration, formulas, seed=0):
+    """
+    Нагружает сервер concurrency клиентами в течение duration секунд.
+    Возвращает словарь {эндпоинт: [(задержка в секундах, успех), ...]} и фактическую длительность.
+    """
+    workload = Workload(formulas, random.Random(seed))
+    requests = {
+        "find_similar": workload.find_similar,
+        "formulas": workload.formulas_list,
+        "manage_formula": workload.manage_formula,
+        "convert_to_docx": workload.convert_to_docx,
+    }
+    names = list(weights)
+    samples = {name: [] for name in names}
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, timeout=REQUEST_TIMEOUT, limits=limits) as client:
+        started = time.perf_counter()
+        deadline = started + duration
+
+        async def worker():
+            while time.perf_counter() < deadline:
+                name = workload.rng.choices(names, weights=[weights[n] for n in names])[0]
+                request_started = time.perf_counter()
+                try:
+                    response = await requests[name](client)
+                    ok = response.status_code < 400
+                except httpx.HTTPError:
+                    ok = False
+                samples[name].append((time.perf_counter() - request_started, ok))
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return samples, elapsed
+
+
+def build_report(samples, elapsed, config):
+    """Сводит замеры в отчёт: по каждому эндпоинту и в целом."""
+    def summarize(measurements):
+        latencies = sorted(latency for latency, _ in measurements)
+        errors = sum(1 for _, ok in measurements if not ok)
+        count = len(measurements)
+        return {
+            "requests": count,
+            "errors": errors,
+            "error_rate": errors / count if count else 0.0,
+            "throughput_rps": count / elapsed if elapsed else 0.0,
+            "latency_ms": {
+                "p50": _ms(percentile(latencies, 0.50)),
+                "p95": _ms(percentile(latencies, 0.95)),
+                "p99": _ms(percentile(latencies, 0.99)),
+                "max": _ms(latencies[-1] if latencies else None),
+            },
+        }
+
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "config": config,
+        "duration_s": elapsed,
+        "endpoints": {name: summarize(measurements) for name, measurements in samples.items()},
+        "total": summarize([m for measurements in samples.values() for m in measurements]),
+    }
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 2) if seconds is not None else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочное тестирование API")
+    parser.add_argument("--url", help="Адрес уже запущенного сервера (база не создаётся)")
+    parser.add_argument("--database-url", help="База для запускаемого сервера (по умолчанию - временная SQLite)")
+    parser.add_argument("--formulas", type=int, default=200, help="Число формул в базе")
+    parser.add_argument("--concurrency", type=int, default=8, help="Число одновременных клиентов")
+    parser.add_argument("--duration", type=float, default=30.0, help="Длительность нагрузки, с")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Веса эндпоинтов, например find_similar=1,formulas=10")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--server-workers", type=int, default=1, help="Число процессов uvicorn")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Файл для JSON-отчёта (по умолчанию - stdout)")
+    args = parser.parse_args()
+
+    weights = parse_mix(args.mix)
+    formulas = generate_formulas(args.formulas, args.seed)
+    config = {key: value for key, value in vars(args).items() if key not in ("output",)}
+    config["mix"] = weights
+
+    process = None
+    temporary_directory = None
+    try:
+        base_url = args.url
+        if base_url is None:
+            database_url = args.database_url
+            if database_url is None:
+                temporary_directory = tempfile.mkdtemp(prefix="loadtest_")
+                database_url = f"sqlite:///{os.path.join(temporary_directory, 'formulas.db')}"
+            config["database"] = database_url.split("://")[0]
+            seeded = seed_database(database_url, args.formulas)
+            print(f"База заполнена: {seeded} формул", file=sys.stderr)
+            process, base_url = start_server(database_url, args.port, args.server_workers)
+
+        print(f"Нагрузка на {base_url}: {args.concurrency} клиентов, {args.duration:.0f} с", file=sys.stderr)
+        samples, elapsed = asyncio.run(run_load(base_url, weights, args.concurrency, args.duration,
+                                                formulas, args.seed))
+        report = build_report(samples, elapsed, config)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+        if temporary_directory is not None:
+            shutil.rmtree(temporary_directory, ignore_errors=True)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text)
+        print(f"Отчёт сохранён: {args.output}", file=sys.stderr)
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,313 @@
+# profiling.py
+"""
+Профилирование отдельных запросов сэмплированием стеков вызовов.
+
+ProfilingMiddleware включает профилирование запроса, если в нём передан
+заголовок X-Profile с секретным токеном (в API - переменная окружения
+PROFILE_TOKEN), либо случайно с заданной вероятностью (PROFILE_SAMPLE_RATE).
+Профиль запроса хранится в контекстной переменной; код, выполняющий тяжёлую работу (например,
+find_similar), оборачивается в profile_thread() - тогда поток, в котором
+он работает, регистрируется в профиле. Отдельный поток-сэмплер раз в
+PROFILE_INTERVAL секунд снимает стеки зарегистрированных потоков
+(sys._current_frames). По завершении запроса профиль сохраняется в
+PROFILE_DIR в формате speedscope (https://www.speedscope.app), его ID
+возвращается в заголовке X-Profile-Id. Профиль без сэмплов (обработчик
+не вызывал profile_thread()) не сохраняется.
+
+Если профилирование запроса не включено, накладные расходы - проверка
+заголовка в middleware и чтение контекстной переменной в profile_thread().
+"""
+import contextvars
+import hmac
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = "x-profile"
+PROFILE_ID_HEADER = "X-Profile-Id"
+DEFAULT_PROFILE_DIR = "profiles"
+DEFAULT_INTERVAL = 0.005
+# Сэмплирование одного запроса прекращается после этого времени
+MAX_PROFILE_SECONDS = 120.0
+MAX_STORED_PROFILES = 200
+SPEEDSCOPE_SCHEMA = "https://www.speedscope.app/file-format-schema.json"
+
+_current_profile = contextvars.ContextVar("current_profile", default=None)
+
+
+def get_profile_directory():
+    return os.environ.get("PROFILE_DIR", DEFAULT_PROFILE_DIR)
+
+
+class RequestProfile:
+    """Стеки, снятые с потоков одного запроса."""
+
+    def __init__(self, name):
+        self.id = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.name = name
+        self.started = time.perf_counter()
+        self.finished = None
+        self._threads = {}   # id потока -> число регистраций
+        self._samples = {}   # id потока -> [(время, стек)]
+        self._lock = threading.Lock()
+
+    def bind(self, thread_id):
+        with self._lock:
+            self._threads[thread_id] = self._threads.get(thread_id, 0) + 1
+            self._samples.setdefault(thread_id, [])
+
+    def unbind(self, thread_id):
+        with self._lock:
+            count = self._threads.get(thread_id, 0) - 1
+            if count > 0:
+                self._threads[thread_id] = count
+            else:
+                self._threads.pop(thread_id, None)
+
+    def sample(self, frames, now):
+        with self._lock:
+            for thread_id in self._threads:
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_name, code.co_filename, code.co_firstlineno))
+                    frame = frame.f_back
+                stack.reverse()
+                self._samples[thread_id].append((now, tuple(stack)))
+
+    def has_samples(self):
+        with self._lock:
+            return any(self._samples.values())
+
+    def to_speedscope(self):
+        """Профиль в формате speedscope: по одному профилю типа sampled на каждый поток."""
+        frames, frame_index = [], {}
+        profiles = []
+        end = (self.finished or time.perf_counter()) - self.started
+        with self._lock:
+            samples_by_thread = {thread_id: list(samples) for thread_id, samples in self._samples.items()}
+        for thread_id, samples in samples_by_thread.items():
+            if not samples:
+                continue
+            stacks, weights = [], []
+            previous = None
+            for timestamp, stack in samples:
+                indices = []
+                for key in stack:
+                    index = frame_index.get(key)
+                    if index is None:
+                        index = frame_index[key] = len(frames)
+                        name, file, line = key
+                        frames.append({"name": name, "file": file, "line": line})
+                    indices.append(index)
+                stacks.append(indices)
+                # Вес сэмпла - время с предыдущего сэмпла: сэмплер может просыпаться с опозданием
+                weights.append(timestamp - previous if previous is not None else _sampler.interval)
+                previous = timestamp
+            profiles.append({
+                "type": "sampled",
+                "name": f"{self.name} (поток {thread_id})",
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": end,
+                "samples": stacks,
+                "weights": weights,
+            })
+        return {
+            "$schema": SPEEDSCOPE_SCHEMA,
+            "name": self.name,
+            "exporter": "formulService profiling",
+            "activeProfileIndex": 0,
+            "shared": {"frames": frames},
+            "profiles": profiles,
+        }
+
+
+class Sampler:
+    """Поток, снимающий стеки потоков активных профилей. Работает, только пока есть активные профили."""
+
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        self._profiles = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, profile):
+        with self._lock:
+            self._profiles.add(profile)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+                self._thread.start()
+
+    def remove(self, profile):
+        with self._lock:
+            self._profiles.discard(profile)
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while True:
+            with self._lock:
+                if not self._profiles:
+                    self._thread = None
+                    return
+                now = time.perf_counter()
+                profiles = [p for p in self._profiles if now - p.started < MAX_PROFILE_SECONDS]
+            frames = sys._current_frames()
+            frames.pop(own_id, None)
+            for profile in profiles:
+                profile.sample(frames, now)
+            del frames
+            time.sleep(self.interval)
+
+
+_sampler = Sampler(float(os.environ.get("PROFILE_INTERVAL", DEFAULT_INTERVAL)))
+
+
+@contextmanager
+def profile_thread():
+    """
+    Регистрирует текущий поток в профиле текущего запроса (если он профилируется)
+    на время выполнения блока.
+    """
+    profile = _current_profile.get()
+    if profile is None:
+        yield
+        return
+    thread_id = threading.get_ident()
+    profile.bind(thread_id)
+    try:
+        yield
+    finally:
+        profile.unbind(thread_id)
+
+
+def start_profile(name):
+    """Начинает профилирование текущего контекста. Возвращает пару (профиль, токен контекстной переменной)."""
+    profile = RequestProfile(name)
+    token = _current_profile.set(profile)
+    _sampler.add(profile)
+    return profile, token
+
+
+def finish_profile(profile, token):
+    """
+    Останавливает профилирование и сохраняет профиль. Возвращает путь к файлу или None.
+    Профиль без сэмплов (обработчик не вызывал profile_thread()) не сохраняется.
+    """
+    _sampler.remove(profile)
+    _current_profile.reset(token)
+    profile.finished = time.perf_counter()
+    if not profile.has_samples():
+        return None
+    directory = get_profile_directory()
+    try:
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{profile.id}.speedscope.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(profile.to_speedscope(), f, ensure_ascii=False)
+        _prune_profiles(directory)
+        return path
+    except OSError as e:
+        logger.error(f"Не удалось сохранить профиль {profile.id}: {e}")
+        return None
+
+
+def _prune_profiles(directory):
+    paths = sorted(list_profiles(directory), key=lambda item: item["created"])
+    for item in paths[:-MAX_STORED_PROFILES]:
+        try:
+            os.remove(os.path.join(directory, item["file"]))
+        except FileNotFoundError:
+            pass
+
+
+def list_profiles(directory=None):
+    """Список сохранённых профилей: ID, файл, размер и время создания."""
+    directory = directory or get_profile_directory()
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for entry in os.scandir(directory):
+        if not entry.name.endswith(".speedscope.json"):
+            continue
+        stat = entry.stat()
+        profiles.append({
+            "id": entry.name[:-len(".speedscope.json")],
+            "file": entry.name,
+            "size": stat.st_size,
+            "created": datetime.fromtimestamp(stat.st_mtime).isoformat(timespec="seconds"),
+        })
+    profiles.sort(key=lambda item: item["created"], reverse=True)
+    return profiles
+
+
+def get_profile_path(profile_id, directory=None):
+    """Путь к файлу профиля по ID или None, если профиля нет (ID не может выходить за пределы каталога)."""
+    directory = directory or get_profile_directory()
+    if not profile_id or os.path.basename(profile_id) != profile_id:
+        return None
+    path = os.path.join(directory, f"{profile_id}.speedscope.json")
+    return path if os.path.isfile(path) else None
+
+
+def token_matches(value, token):
+    """Сравнивает переданный токен с секретным за постоянное время."""
+    if value is None or token is None:
+        return False
+    return hmac.compare_digest(value.encode("utf-8"), token.encode("utf-8"))
+
+
+def should_profile(headers, token, sample_rate):
+    """Решает, профилировать ли запрос: по заголовку X-Profile с токеном или случайно с вероятностью sample_rate."""
+    if token_matches(headers.get(PROFILE_HEADER), token):
+        return True
+    return sample_rate > 0 and random.random() < sample_rate
+
+
+class ProfilingMiddleware:
+    """ASGI-middleware: профилирует выбранные HTTP-запросы и добавляет в ответ X-Profile-Id."""
+
+    def __init__(self, app, token=None, sample_rate=0.0, paths=None):
+        self.app = app
+        self.token = token
+        self.sample_rate = sample_rate
+        # Профилируются только запросы к этим путям (None - к любым)
+        self.paths = set(paths) if paths else None
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] != "http" or (self.token is None and self.sample_rate <= 0)
+                or (self.paths is not None and scope["path"] not in self.paths)):
+            await self.app(scope, receive, send)
+            return
+        headers = {key.decode("latin-1").lower(): value.decode("latin-1") for key, value in scope["headers"]}
+        if not should_profile(headers, self.token, self.sample_rate):
+            await self.app(scope, receive, send)
+            return
+
+        profile, token = start_profile(f"{scope['method']} {scope['path']}")
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                message = dict(message)
+                message["headers"] = list(message.get("headers", [])) + [
+                    (PROFILE_ID_HEADER.lower().encode("latin-1"), profile.id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            path = finish_profile(profile, token)
+            if path:
+                logger.info(f"Профиль запроса {profile.name} сохранён: {path}")
@@ -0,0 +1,217 @@
+# render.py
+"""
+Отрисовка одной формулы в SVG или PNG для превью (/render).
+
+Картинка однозначно определяется параметрами запроса (LaTeX, формат, размер
+шрифта, DPI), поэтому хранится в дисковом кеше под ключом - хешем этих
+параметров (content-addressed). Ключ же служит сильным ETag: одинаковые
+параметры всегда дают одинаковые байты. Размер кеша ограничен, при
+переполнении удаляются файлы, к которым дольше всего не обращались
+(порядок обращений хранится в памяти, между перезапусками - в mtime
+файлов). Чтение и запись кеша выполняются вне цикла событий. Отрисовка
+выполняется в пуле процессов, одновременные запросы одной и той же
+картинки объединяются.
+"""
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from coalesce import RequestCoalescer
+
+logger = logging.getLogger(__name__)
+
+RENDER_FORMATS = {"svg": "image/svg+xml", "png": "image/png"}
+DEFAULT_FONT_SIZE = 24
+DEFAULT_DPI = 100
+MIN_FONT_SIZE, MAX_FONT_SIZE = 4, 200
+MIN_DPI, MAX_DPI = 50, 600
+MAX_LATEX_LENGTH = 2000
+FORMULA_COLOR = "navy"
+# Версия отрисовки входит в ключ кеша: при изменении оформления старые файлы не используются
+RENDER_VERSION = 1
+
+DEFAULT_CACHE_DIR = "render_cache"
+DEFAULT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# После вытеснения в кеше остаётся не больше этой доли лимита
+EVICT_TO_FRACTION = 0.9
+
+
+def render_key(latex, fmt, font_size, dpi):
+    """Ключ кеша (он же ETag без кавычек) для параметров отрисовки."""
+    params = json.dumps([RENDER_VERSION, latex, fmt, font_size, dpi], ensure_ascii=False)
+    return hashlib.blake2b(params.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def render_formula(latex, fmt, font_size=DEFAULT_FONT_SIZE, dpi=DEFAULT_DPI):
+    """
+    Рисует формулу mathtext и возвращает байты SVG или PNG.
+    Вывод детерминирован (без даты в метаданных, фиксированная соль id в SVG).
+    Выполняется в процессе пула. ValueError - формулу не удалось разобрать.
+    """
+    import matplotlib
+    from matplotlib.figure import Figure
+
+    matplotlib.rcParams["svg.hashsalt"] = "formula-render"
+    matplotlib.rcParams["svg.fonttype"] = "path"
+
+    figure = Figure(figsize=(0.01, 0.01))
+    figure.text(0, 0, f"${latex}$", fontsize=font_size, color=FORMULA_COLOR)
+    buffer = io.BytesIO()
+    metadata = {"Date": None} if fmt == "svg" else {"Software": None}
+    figure.savefig(buffer, format=fmt, dpi=dpi, bbox_inches="tight", pad_inches=0.05,
+                   transparent=True, metadata=metadata)
+    return buffer.getvalue()
+
+
+class RenderCache:
+    """
+    Дисковый кеш картинок с вытеснением давно не использованных файлов (LRU).
+    Порядок использования и размеры файлов хранятся в памяти; каталог сканируется
+    только при создании кеша (порядок восстанавливается по mtime, который обновляется
+    при каждом обращении). Методы выполняют дисковый ввод-вывод и вызываются вне цикла событий.
+    """
+
+    def __init__(self, directory, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._entries = OrderedDict(
+            (path, size) for path, _, size in sorted(self._scan(), key=lambda entry: entry[1]))
+        self._size = sum(self._entries.values())
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key, fmt):
+        return os.path.join(self.directory, key[:2], f"{key}.{fmt}")
+
+    def _scan(self):
+        for subdirectory in os.scandir(self.directory):
+            if not subdirectory.is_dir():
+                continue
+            for entry in os.scandir(subdirectory.path):
+                if entry.name.endswith(".tmp"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield entry.path, stat.st_mtime, stat.st_size
+
+    def get(self, key, fmt):
+        """Возвращает байты картинки из кеша или None. Обращение обновляет mtime файла."""
+        path = self._path(key, fmt)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+                size = self._entries.pop(path, None)
+                if size is not None:
+                    self._size -= size
+            return None
+        with self._lock:
+            self.hits += 1
+            # Файл мог записать другой процесс с тем же каталогом кеша
+            if path not in self._entries:
+                self._entries[path] = len(data)
+                self._size += len(data)
+            self._entries.move_to_end(path)
+        return data
+
+    def put(self, key, fmt, data):
+        """Атомарно сохраняет картинку и при переполнении вытесняет старые файлы."""
+        path = self._path(key, fmt)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temporary, "wb") as f:
+            f.write(data)
+        os.replace(temporary, path)
+        with self._lock:
+            self._size += len(data) - self._entries.pop(path, 0)
+            self._entries[path] = len(data)
+            victims = self._evict() if self._size > self.max_bytes else []
+        for victim in victims:
+            try:
+                os.remove(victim)
+            except FileNotFoundError:
+                pass
+        if victims:
+            logger.info(f"Кеш отрисовки: удалено {len(victims)} файлов, занято {self._size / 1024 / 1024:.1f} МБ")
+
+    def _evict(self):
+        """Убирает из индекса давно не использованные файлы и возвращает их пути для удаления."""
+        target = self.max_bytes * EVICT_TO_FRACTION
+        victims = []
+        while self._entries and self._size > target:
+            path, size = self._entries.popitem(last=False)
+            self._size -= size
+            victims.append(path)
+        return victims
+
+
+class FormulaRenderer:
+    """Отрисовка формул в пуле процессов с дисковым кешем и объединением одинаковых запросов."""
+
+    def __init__(self, cache, workers=None):
+        self.cache = cache
+        self.workers = workers or os.cpu_count() or 1
+        self._executor = None
+        self._coalescer = None
+        self._lock = threading.Lock()
+
+    def _get_coalescer(self):
+        with self._lock:
+            if self._coalescer is None:
+                # spawn: fork процесса веб-сервера с потоками небезопасен
+                context = multiprocessing.get_context("spawn")
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+                self._coalescer = RequestCoalescer(self._executor)
+            return self._coalescer
+
+    async def render(self, latex, fmt, font_size=DEFAULT_FONT_SIZE, dpi=DEFAULT_DPI):
+        """Возвращает пару (ключ, байты картинки), рисуя её только при промахе кеша."""
+        key = render_key(latex, fmt, font_size, dpi)
+        loop = asyncio.get_running_loop()
+        # Чтение и запись кеша - дисковые операции, они не должны блокировать цикл событий
+        data = await loop.run_in_executor(None, self.cache.get, key, fmt)
+        if data is None:
+            data = await self._get_coalescer().run((key, fmt), render_formula, latex, fmt, font_size, dpi)
+            await loop.run_in_executor(None, self.cache.put, key, fmt, data)
+        return key, data
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+                self._coalescer = None
+
+
+_renderer = None
+_renderer_lock = threading.Lock()
+
+
+def get_renderer():
+    """
+    Возвращает отрисовщик процесса. Настройки берутся из переменных окружения
+    RENDER_CACHE_DIR, RENDER_CACHE_MAX_BYTES и RENDER_WORKERS.
+    """
+    global _renderer
+    with _renderer_lock:
+        if _renderer is None:
+            cache = RenderCache(os.environ.get("RENDER_CACHE_DIR", DEFAULT_CACHE_DIR),
+                                int(os.environ.get("RENDER_CACHE_MAX_BYTES", DEFAULT_CACHE_MAX_BYTES)))
+            workers = int(os.environ["RENDER_WORKERS"]) if os.environ.get("RENDER_WORKERS") else None
+            _renderer = FormulaRenderer(cache, workers)
+        return _renderer
@@ -0,0 +1,233 @@
+# scheduler.py
+"""
+Контроль допуска и приоритетное планирование запросов к API.
+
+Эндпоинты делятся на классы (например, лёгкие интерактивные, поиск, экспорт).
+У каждого класса свой лимит одновременно выполняемых запросов и своя очередь:
+всплеск тяжёлых запросов одного класса занимает только его слоты и не
+вытесняет лёгкие запросы других классов.
+
+Запрос, не получивший слот сразу, ждёт в очереди класса. Очередь упорядочена
+по приоритету (заголовок X-Priority, меньше - раньше; не меньше 0 - клиент может только
+понизить свой приоритет), затем по дедлайну
+(время ожидания класса или заголовок X-Request-Timeout в секундах, если он меньше).
+Если очередь заполнена, запрос сразу отклоняется с 429 и заголовком Retry-After
+(оценка по среднему времени обслуживания); если дедлайн истёк в очереди - 503.
+
+Вся работа планировщика идёт в цикле событий, поэтому блокировки не нужны.
+Метрики (выполняется, в очереди, ожидание, отказы) отдаёт metrics().
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import os
+import time
+from collections import deque
+
+from starlette.responses import JSONResponse
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_HEADER = "x-priority"
+TIMEOUT_HEADER = "x-request-timeout"
+# Сколько последних времён ожидания хранится для перцентилей
+WAIT_SAMPLES = 1000
+# Коэффициент экспоненциального сглаживания времени обслуживания
+SERVICE_TIME_SMOOTHING = 0.2
+MAX_RETRY_AFTER = 60
+
+
+class Rejected(Exception):
+    """Запрос не допущен: очередь заполнена (429) или истёк дедлайн в очереди (503)."""
+
+    def __init__(self, status_code, detail, retry_after):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class RequestClass:
+    """Класс эндпоинтов: лимит одновременных запросов, размер очереди и максимальное ожидание в ней."""
+
+    def __init__(self, name, concurrency, max_queue, queue_timeout):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+
+        self.running = 0
+        self._queue = []   # (приоритет, дедлайн, номер, future)
+        self._counter = itertools.count()
+        self.admitted = 0
+        self.shed = 0
+        self.expired = 0
+        self.max_wait = 0.0
+        self._waits = deque(maxlen=WAIT_SAMPLES)
+        self.service_time = None
+
+    @classmethod
+    def from_env(cls, name, concurrency, max_queue, queue_timeout):
+        """
+        Класс с настройками по умолчанию, которые можно переопределить переменными окружения
+        SCHEDULER_<ИМЯ>_CONCURRENCY, SCHEDULER_<ИМЯ>_QUEUE и SCHEDULER_<ИМЯ>_TIMEOUT.
+        """
+        prefix = f"SCHEDULER_{name.upper()}_"
+        return cls(
+            name,
+            int(os.environ.get(prefix + "CONCURRENCY", concurrency)),
+            int(os.environ.get(prefix + "QUEUE", max_queue)),
+            float(os.environ.get(prefix + "TIMEOUT", queue_timeout)),
+        )
+
+    def queued(self):
+        return sum(1 for *_, future in self._queue if not future.done())
+
+    def retry_after(self):
+        """Оценка (в секундах), через сколько стоит повторить запрос."""
+        service_time = self.service_time or 1.0
+        estimate = service_time * (self.queued() + 1) / max(self.concurrency, 1)
+        return max(1, min(MAX_RETRY_AFTER, math.ceil(estimate)))
+
+    async def acquire(self, priority=0, timeout=None):
+        """Ждёт свободный слот класса. Возвращает время ожидания в секундах или бросает Rejected."""
+        started = time.monotonic()
+        if self.running < self.concurrency and not self.queued():
+            self.running += 1
+            self._record_wait(0.0)
+            return 0.0
+        if self.queued() >= self.max_queue:
+            self.shed += 1
+            raise Rejected(429, f"Очередь запросов класса {self.name} заполнена.", self.retry_after())
+
+        timeout = self.queue_timeout if timeout is None else min(timeout, self.queue_timeout)
+        if len(self._queue) > 2 * self.max_queue:
+            # Отменённые ожидания убираются из кучи при передаче слотов; если слоты долго
+            # не освобождаются, куча чистится здесь
+            self._queue = [entry for entry in self._queue if not entry[-1].done()]
+            heapq.heapify(self._queue)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, started + timeout, next(self._counter), future))
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            if not future.done():
+                future.cancel()
+                self.expired += 1
+                raise Rejected(503, f"Истекло время ожидания в очереди класса {self.name}.", self.retry_after())
+        except asyncio.CancelledError:
+            # Слот мог быть передан этому запросу в момент отмены - его нужно вернуть
+            if future.done() and not future.cancelled():
+                self.release()
+            else:
+                future.cancel()
+            raise
+        wait = time.monotonic() - started
+        self._record_wait(wait)
+        return wait
+
+    def release(self, service_time=None):
+        """Освобождает слот и передаёт его следующему запросу из очереди."""
+        if service_time is not None:
+            if self.service_time is None:
+                self.service_time = service_time
+            else:
+                self.service_time += SERVICE_TIME_SMOOTHING * (service_time - self.service_time)
+        while self._queue:
+            *_, future = heapq.heappop(self._queue)
+            if not future.done():
+                # Слот переходит ожидающему без уменьшения счётчика
+                future.set_result(None)
+                return
+        self.running -= 1
+
+    def _record_wait(self, wait):
+        self.admitted += 1
+        self.max_wait = max(self.max_wait, wait)
+        self._waits.append(wait)
+
+    def metrics(self):
+        waits = sorted(self._waits)
+
+        def wait_percentile(fraction):
+            if not waits:
+                return 0.0
+            return round(waits[min(len(waits) - 1, int(fraction * len(waits)))] * 1000, 2)
+
+        return {
+            "concurrency": self.concurrency,
+            "max_queue": self.max_queue,
+            "queue_timeout_s": self.queue_timeout,
+            "running": self.running,
+            "queued": self.queued(),
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "expired": self.expired,
+            "wait_ms": {
+                "p50": wait_percentile(0.50),
+                "p95": wait_percentile(0.95),
+                "p99": wait_percentile(0.99),
+                "max": round(self.max_wait * 1000, 2),
+            },
+            "service_time_ms": round(self.service_time * 1000, 2) if self.service_time is not None else None,
+        }
+
+
+class AdmissionController:
+    """Сопоставляет пути запросов классам. Пути, не отнесённые ни к одному классу, не ограничиваются."""
+
+    def __init__(self, classes, routes):
+        self.classes = {request_class.name: request_class for request_class in classes}
+        self.routes = dict(routes)
+
+    def classify(self, path):
+        name = self.routes.get(path)
+        return self.classes[name] if name is not None else None
+
+    def metrics(self):
+        return {name: request_class.metrics() for name, request_class in self.classes.items()}
+
+
+def _header_number(headers, name, convert, default):
+    value = headers.get(name)
+    if value is None:
+        return default
+    try:
+        return convert(value)
+    except ValueError:
+        return default
+
+
+class AdmissionMiddleware:
+    """ASGI-middleware: пропускает запрос к эндпоинту только при свободном слоте его класса."""
+
+    def __init__(self, app, controller):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        request_class = self.controller.classify(scope["path"]) if scope["type"] == "http" else None
+        if request_class is None:
+            await self.app(scope, receive, send)
+            return
+
+        headers = {key.decode("latin-1").lower(): value.decode("latin-1") for key, value in scope["headers"]}
+        # Отрицательный приоритет обгонял бы остальных клиентов - допускаются только значения >= 0
+        priority = max(0, _header_number(headers, PRIORITY_HEADER, int, 0))
+        timeout = _header_number(headers, TIMEOUT_HEADER, float, None)
+        try:
+            await request_class.acquire(priority, timeout)
+        except Rejected as e:
+            logger.warning(f"Запрос {scope['path']} отклонён ({e.status_code}): {e.detail}")
+            response = JSONResponse({"detail": e.detail}, status_code=e.status_code,
+                                    headers={"Retry-After": str(e.retry_after)})
+            await response(scope, receive, send)
+            return
+
+        started = time.monotonic()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            request_class.release(time.monotonic() - started)
@@ -0,0 +1,161 @@
+# search.py
+import heapq
+import logging
+
+import sympy
+
+from index import compare_prepared, prepare_formula
+from profiling import profile_thread
+
+logger = logging.getLogger(__name__)
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+DEFAULT_TOP_K = 10
+
+
+def normalize_latex(formula):
+    """Нормализует LaTeX-строку для сравнения запросов: схлопывает пробелы."""
+    return " ".join(formula.split())
+
+
+def formula_to_dict(formula):
+    """
+    Преобразует строку таблицы formulas в словарь в формате FormulaResponse.
+    """
+    return {
+        "id": formula.id,
+        "latex_formula": formula.latex_formula,
+        "author_id": formula.author_id,
+        "legend": formula.legend,
+        "description": formula.description,
+        "creation_date": formula.creation_date.strftime(DATE_FORMAT) if formula.creation_date else None,
+        "update_date": formula.update_date.strftime(DATE_FORMAT) if formula.update_date else None,
+    }
+
+
+def compare_latex(prepared_input, latex_formula, prepared=None, assumptions=None):
+    """
+    Сравнивает подготовленную входную формулу с LaTeX-формулой каталога.
+    prepared - заранее подготовленная формула каталога (например, из снапшота),
+    если её нет, формула подготавливается здесь.
+    Возвращает словарь в формате DetailedSimilarityInfo без поля formula.
+    """
+    if prepared is None:
+        prepared = prepare_formula(latex_formula, assumptions)
+
+    (equivalent,
+     similarity,
+     common_subexpressions,
+     common_indices_in_expr2,
+     substring_occurrences_in_simplified2,
+     simplified1,
+     _,
+     latex_simplified2) = compare_prepared(prepared_input, prepared, with_latex=True)
+
+    common_info_list = [
+        {
+            "subexpression": subexpr,
+            "indices_in_expr2": common_indices_in_expr2[subexpr],
+            "occurrences_in_simplified2": substring_occurrences_in_simplified2[subexpr],
+        }
+        for subexpr in common_subexpressions
+    ]
+
+    return {
+        "equivalent": equivalent,
+        "similarity": similarity,
+        "simplified1": sympy.latex(simplified1),
+        "simplified2": latex_simplified2,
+        "common_subexpressions": common_info_list,
+    }
+
+
+def compare_with_formula(prepared_input, formula, prepared=None, assumptions=None):
+    """
+    Сравнивает подготовленную входную формулу со строкой каталога (см. compare_latex).
+    Возвращает словарь в формате DetailedSimilarityInfo.
+    """
+    result = compare_latex(prepared_input, formula.latex_formula, prepared, assumptions)
+    return {"formula": formula_to_dict(formula), **result}
+
+
+def top_k(results, k=DEFAULT_TOP_K):
+    """
+    Оставляет k результатов с наибольшим сходством.
+    Порядок равных по сходству результатов сохраняется, как у sorted().
+    """
+    indexed = list(enumerate(results))
+    best = heapq.nlargest(k, indexed, key=lambda item: (item[1]["similarity"], -item[0]))
+    return [result for _, result in best]
+
+
+def order_candidates(prepared_input, formulas, store=None):
+    """
+    Переупорядочивает формулы каталога так, чтобы вероятные эквивалентные формулы
+    (совпадает нормализованный LaTeX или числовой отпечаток из снапшота) шли первыми.
+    Остальные формулы сохраняют исходный порядок.
+    """
+    input_latex = normalize_latex(prepared_input.latex)
+    likely, others = [], []
+    for formula in formulas:
+        if normalize_latex(formula.latex_formula) == input_latex:
+            likely.append(formula)
+            continue
+        features = None
+        if store is not None and prepared_input.fingerprint is not None:
+            try:
+                features = store.get_fingerprint(formula.id, formula.latex_formula)
+            except Exception:
+                features = None
+        if features == (prepared_input.num_vars, prepared_input.fingerprint):
+            likely.append(formula)
+        else:
+            others.append(formula)
+    return likely + others
+
+
+def find_similar(input_formula, formulas, k=DEFAULT_TOP_K, assumptions=None, store=None, load_rows=None):
+    """
+    Сравнивает входную формулу со всеми переданными формулами
+    и возвращает k наиболее похожих (в формате DetailedSimilarityInfo).
+    formulas - строки с полями id и latex_formula: полные строки Formula
+    или пары (id, latex_formula) из db.iter_formula_sources.
+    load_rows - функция, возвращающая по списку ID словарь {id: Formula};
+    если она задана, полные строки читаются только для k лучших результатов,
+    иначе formulas должны быть полными строками.
+    store - снапшот с подготовленными формулами каталога (см. snapshot.py);
+    формулы, которых в нём нет, подготавливаются на лету.
+    Формулы, которые не удалось сравнить, пропускаются.
+    Если запрос профилируется (см. profiling.py), поток поиска попадает в его профиль.
+    """
+    with profile_thread():
+        try:
+            prepared_input = prepare_formula(input_formula, assumptions)
+        except Exception as e:
+            logger.error(f"Ошибка при разборе входной формулы: {e}")
+            return []
+
+        # Снапшот строится без допущений о переменных
+        if assumptions:
+            store = None
+
+        results = []
+        for formula in formulas:
+            try:
+                prepared = store.get(formula.id, formula.latex_formula) if store is not None else None
+                if load_rows is None:
+                    results.append(compare_with_formula(prepared_input, formula, prepared, assumptions))
+                else:
+                    result = compare_latex(prepared_input, formula.latex_formula, prepared, assumptions)
+                    results.append({"formula": formula.id, **result})
+            except Exception as e:
+                logger.error(f"Ошибка при сравнении формул ID {formula.id}: {e}")
+                continue
+        best = top_k(results, k)
+        if load_rows is None:
+            return best
+
+        rows = load_rows([result["formula"] for result in best])
+        # Формулы, удалённые после чтения каталога, в ответ не попадают
+        return [{**result, "formula": formula_to_dict(rows[result["formula"]])}
+                for result in best if result["formula"] in rows]
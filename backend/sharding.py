@@ -0,0 +1,177 @@
+# sharding.py
+"""
+Шардированный поиск похожих формул (scatter-gather).
+
+Каталог делится между N поисковыми воркерами (по хешу или диапазону id).
+Каждый воркер выполняет compare_formulas_sympy только на своём шарде,
+а координатор рассылает запрос всем шардам, ждёт ответы не дольше
+дедлайна и объединяет частичные top-K в общий top-K.
+
+Локальный запуск нескольких воркеров, имитирующих отдельные узлы:
+    python sharding.py --shards 3 --base-port 8101
+После этого в API указывается
+    SEARCH_SHARD_URLS=http://127.0.0.1:8101,http://127.0.0.1:8102,http://127.0.0.1:8103
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Optional
+
+from fastapi import FastAPI, Depends, HTTPException
+from pydantic import BaseModel
+from sqlalchemy.orm import Session
+
+from db import get_db, get_formulas_by_ids, iter_formula_sources
+from search import find_similar, top_k, DEFAULT_TOP_K
+from snapshot import get_snapshot_store
+
+logger = logging.getLogger(__name__)
+
+SHARD_SEARCH_PATH = "/shard/find_similar"
+DEFAULT_DEADLINE = 10.0
+
+
+class ShardSearchRequest(BaseModel):
+    formula: str
+    top_k: int = DEFAULT_TOP_K
+
+
+def create_worker_app(shard_index: int, num_shards: int, strategy: str = "hash") -> FastAPI:
+    """
+    Создаёт приложение поискового воркера, отвечающего за один шард каталога.
+    """
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"Некорректный номер шарда {shard_index} для {num_shards} шардов")
+
+    worker_app = FastAPI(title=f"Formula search shard {shard_index}/{num_shards}")
+
+    @worker_app.post(SHARD_SEARCH_PATH)
+    def shard_find_similar(request: ShardSearchRequest, db: Session = Depends(get_db)):
+        try:
+            formulas = list(iter_formula_sources(db, shard_index, num_shards, strategy))
+            results = find_similar(request.formula, formulas, k=request.top_k, store=get_snapshot_store(),
+                                   load_rows=lambda ids: get_formulas_by_ids(db, ids))
+            return {"shard": shard_index, "scanned": len(formulas), "results": results}
+        except Exception as e:
+            logger.error(f"Ошибка поиска на шарде {shard_index}: {e}")
+            raise HTTPException(status_code=500, detail=f"Ошибка поиска на шарде {shard_index}: {e}")
+
+    return worker_app
+
+
+def get_shard_urls():
+    """Возвращает список адресов шардов из переменной окружения SEARCH_SHARD_URLS."""
+    raw = os.environ.get("SEARCH_SHARD_URLS", "")
+    return [url.strip().rstrip("/") for url in raw.split(",") if url.strip()]
+
+
+def query_shard(base_url: str, formula: str, k: int, timeout: float):
+    """Отправляет поисковый запрос одному шарду и возвращает его ответ."""
+    body = json.dumps({"formula": formula, "top_k": k}).encode("utf-8")
+    request = urllib.request.Request(
+        base_url + SHARD_SEARCH_PATH,
+        data=body,
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read().decode("utf-8"))
+
+
+def _is_timeout(error):
+    """Истёк ли таймаут сокета (при соединении urllib заворачивает его в URLError)."""
+    if isinstance(error, urllib.error.URLError):
+        error = error.reason
+    return isinstance(error, TimeoutError)
+
+
+def scatter_gather(formula: str, shard_urls, k: int = DEFAULT_TOP_K, deadline: Optional[float] = None):
+    """
+    Рассылает запрос всем шардам параллельно и объединяет их top-K.
+    Шарды, не ответившие до дедлайна или вернувшие ошибку, пропускаются -
+    результат тогда частичный, что отражается в поле "partial".
+    """
+    deadline = DEFAULT_DEADLINE if deadline is None else deadline
+    executor = ThreadPoolExecutor(max_workers=max(len(shard_urls), 1))
+    try:
+        futures = {executor.submit(query_shard, url, formula, k, deadline): url for url in shard_urls}
+        done, not_done = wait(futures, timeout=deadline)
+    finally:
+        # Не ждём медленные шарды: их потоки завершатся по таймауту сокета
+        executor.shutdown(wait=False)
+
+    merged = []
+    answered, failed = [], []
+    # Таймаут сокета равен дедлайну, поэтому шард, не успевший ответить,
+    # может завершиться таймаутом раньше, чем wait вернёт его в not_done
+    timed_out = [futures[future] for future in not_done]
+    for future in done:
+        url = futures[future]
+        try:
+            merged.extend(future.result()["results"])
+            answered.append(url)
+        except Exception as e:
+            if _is_timeout(e):
+                timed_out.append(url)
+                continue
+            logger.error(f"Шард {url} вернул ошибку: {e}")
+            failed.append(url)
+    for url in timed_out:
+        logger.warning(f"Шард {url} не ответил за {deadline} с")
+
+    # Порядок ответов шардов случаен - при равном сходстве упорядочиваем по id
+    merged.sort(key=lambda result: result["formula"]["id"])
+    return {
+        "results": top_k(merged, k),
+        "shards_total": len(shard_urls),
+        "shards_answered": len(answered),
+        "shards_failed": failed,
+        "shards_timed_out": timed_out,
+        "partial": bool(failed or timed_out),
+    }
+
+
+def run_worker(shard_index: int, num_shards: int, port: int, strategy: str = "hash", host: str = "127.0.0.1"):
+    """Запускает один поисковый воркер (блокирующий вызов)."""
+    import uvicorn
+    uvicorn.run(create_worker_app(shard_index, num_shards, strategy), host=host, port=port, log_level="info")
+
+
+def run_local_cluster(num_shards: int, base_port: int, strategy: str = "hash"):
+    """
+    Запускает num_shards воркеров в отдельных процессах на портах base_port, base_port + 1, ...
+    Возвращает список процессов и список адресов шардов.
+    """
+    processes = []
+    urls = []
+    # spawn: при fork воркеры унаследовали бы открытые соединения пула db.engine
+    context = multiprocessing.get_context("spawn")
+    for shard_index in range(num_shards):
+        port = base_port + shard_index
+        process = context.Process(
+            target=run_worker,
+            args=(shard_index, num_shards, port, strategy),
+            daemon=True,
+        )
+        process.start()
+        processes.append(process)
+        urls.append(f"http://127.0.0.1:{port}")
+    return processes, urls
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Локальный кластер поисковых шардов")
+    parser.add_argument("--shards", type=int, default=2)
+    parser.add_argument("--base-port", type=int, default=8101)
+    parser.add_argument("--strategy", choices=["hash", "range"], default="hash")
+    args = parser.parse_args()
+
+    processes, urls = run_local_cluster(args.shards, args.base_port, args.strategy)
+    print(f"SEARCH_SHARD_URLS={','.join(urls)}")
+    for process in processes:
+        process.join()
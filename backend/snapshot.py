@@ -0,0 +1,353 @@
+# snapshot.py
+"""
+Бинарный снапшот поискового индекса формул.
+
+Для каждой формулы каталога хранятся предвычисленные данные prepare_formula:
+канонические формы, размер, хеши поддеревьев и числовой отпечаток.
+Воркеры открывают файл через mmap (страницы общие для всех процессов)
+и декодируют записи по требованию, поэтому запуск мгновенный,
+а память на воркер не растёт с размером каталога.
+
+Изменения после построения снапшота дописываются в журнал <snapshot>.delta
+(JSON-строки) и накладываются поверх снапшота при открытии.
+
+Формат файла (little-endian):
+    заголовок  : magic b"FSNP", версия формата (u16), резерв (u16),
+                 число записей (u32), время построения (f64)
+    таблица    : для каждой записи id (u32), смещение (u64), длина (u32); отсортирована по id
+    данные     : для каждой записи длина JSON (u32), число хешей (u32), число точек отпечатка (u32),
+                 JSON с формулой и каноническими формами, хеши (u64[]), отпечаток (f64[] пары re/im)
+
+Построение снапшота:
+    python snapshot.py build formulas.snap
+"""
+import bisect
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+
+import sympy
+from sympy.core.function import AppliedUndef
+
+from index import PreparedFormula, prepare_formula
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_MAGIC = b"FSNP"
+SNAPSHOT_VERSION = 1
+
+HEADER = struct.Struct("<4sHHId")
+TABLE_ENTRY = struct.Struct("<IQI")
+RECORD_HEADER = struct.Struct("<III")
+
+
+def encode_expr(expr):
+    """Кодирует выражение SymPy во вложенные списки, пригодные для JSON."""
+    if isinstance(expr, sympy.Symbol):
+        return ["S", expr.name]
+    if isinstance(expr, sympy.Integer):
+        return ["I", str(expr.p)]
+    if isinstance(expr, sympy.Rational):
+        return ["Q", str(expr.p), str(expr.q)]
+    if isinstance(expr, sympy.Float):
+        return ["F", str(expr), expr._prec]
+    if expr.is_Atom:
+        return ["C", sympy.srepr(expr)]
+    args = [encode_expr(arg) for arg in expr.args]
+    if isinstance(expr, AppliedUndef):
+        return ["U", expr.func.__name__, args]
+    return ["N", type(expr).__name__, args]
+
+
+def decode_expr(data):
+    """
+    Восстанавливает выражение из encode_expr.
+    Add и Mul собираются без вычисления, остальные узлы - так же, как в canonical_form.
+    """
+    kind = data[0]
+    if kind == "S":
+        return sympy.Symbol(data[1])
+    if kind == "I":
+        return sympy.Integer(int(data[1]))
+    if kind == "Q":
+        return sympy.Rational(int(data[1]), int(data[2]))
+    if kind == "F":
+        return sympy.Float(data[1], precision=data[2])
+    if kind == "C":
+        return sympy.sympify(data[1])
+    args = [decode_expr(arg) for arg in data[2]]
+    if kind == "U":
+        return sympy.Function(data[1])(*args)
+    func = getattr(sympy, data[1])
+    if func in (sympy.Add, sympy.Mul):
+        return func(*args, evaluate=False)
+    return func(*args)
+
+
+def encode_record(prepared: PreparedFormula):
+    """Сериализует подготовленную формулу в запись снапшота."""
+    payload = json.dumps({
+        "latex": prepared.latex,
+        "num_vars": prepared.num_vars,
+        "size": prepared.size,
+        "renamed": encode_expr(prepared.canonical_renamed),
+        "plain": encode_expr(prepared.canonical_plain),
+    }, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    fingerprint = prepared.fingerprint or ()
+    flat_fingerprint = [part for point in fingerprint for part in point]
+    return b"".join((
+        RECORD_HEADER.pack(len(payload), len(prepared.hashes), len(fingerprint)),
+        payload,
+        struct.pack(f"<{len(prepared.hashes)}Q", *prepared.hashes),
+        struct.pack(f"<{len(flat_fingerprint)}d", *flat_fingerprint),
+    ))
+
+
+def _unpack_record(buffer, offset):
+    json_len, n_hashes, n_points = RECORD_HEADER.unpack_from(buffer, offset)
+    offset += RECORD_HEADER.size
+    payload = json.loads(bytes(buffer[offset:offset + json_len]).decode("utf-8"))
+    offset += json_len
+    hashes = struct.unpack_from(f"<{n_hashes}Q", buffer, offset)
+    offset += 8 * n_hashes
+    flat = struct.unpack_from(f"<{2 * n_points}d", buffer, offset)
+    fingerprint = tuple(zip(flat[0::2], flat[1::2])) if n_points else None
+    return payload, hashes, fingerprint
+
+
+def decode_record(buffer, offset):
+    """Восстанавливает подготовленную формулу из записи снапшота."""
+    payload, hashes, fingerprint = _unpack_record(buffer, offset)
+    return PreparedFormula(
+        latex=payload["latex"],
+        canonical_renamed=decode_expr(payload["renamed"]),
+        canonical_plain=decode_expr(payload["plain"]),
+        num_vars=payload["num_vars"],
+        size=payload["size"],
+        hashes=list(hashes),
+        fingerprint=fingerprint,
+    )
+
+
+def decode_record_fingerprint(buffer, offset):
+    """
+    Читает из записи снапшота только LaTeX, число переменных и числовой отпечаток,
+    не восстанавливая канонические формы.
+    """
+    payload, _, fingerprint = _unpack_record(buffer, offset)
+    return payload["latex"], payload["num_vars"], fingerprint
+
+
+def delta_path(path):
+    return path + ".delta"
+
+
+def append_delta(path, op, formula_id, latex_formula=None):
+    """
+    Дописывает изменение каталога в журнал снапшота.
+    op: "upsert" (создание или обновление) или "delete".
+    """
+    entry = {"op": op, "id": formula_id, "latex": latex_formula}
+    with open(delta_path(path), "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
+def write_snapshot(path, formulas):
+    """
+    Строит снапшот из пар (id, latex_formula) и атомарно заменяет им файл path.
+    Формулы, которые не удалось разобрать, в снапшот не попадают.
+    Возвращает число записанных формул.
+    """
+    delta_offset = os.path.getsize(delta_path(path)) if os.path.exists(delta_path(path)) else 0
+
+    records = []
+    for formula_id, latex_formula in formulas:
+        try:
+            records.append((formula_id, encode_record(prepare_formula(latex_formula))))
+        except Exception as e:
+            logger.error(f"Формула ID {formula_id} пропущена при построении снапшота: {e}")
+    records.sort(key=lambda record: record[0])
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, len(records), time.time()))
+        offset = HEADER.size + TABLE_ENTRY.size * len(records)
+        for formula_id, data in records:
+            f.write(TABLE_ENTRY.pack(formula_id, offset, len(data)))
+            offset += len(data)
+        for _, data in records:
+            f.write(data)
+    os.replace(tmp_path, path)
+
+    # Изменения, записанные в журнал во время построения, могли не попасть в снапшот -
+    # оставляем их (повторное применение upsert/delete безопасно)
+    if os.path.exists(delta_path(path)):
+        with open(delta_path(path), "rb") as f:
+            f.seek(delta_offset)
+            tail = f.read()
+        with open(delta_path(path), "wb") as f:
+            f.write(tail)
+    return len(records)
+
+
+class SnapshotStore:
+    """
+    Снапшот, открытый через mmap, с наложенным журналом изменений.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, count, self.created_at = HEADER.unpack_from(self._mmap, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f"{path} не является снапшотом формул")
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f"Неподдерживаемая версия снапшота {version} (ожидается {SNAPSHOT_VERSION})")
+        self.count = count
+        table = memoryview(self._mmap)[HEADER.size:HEADER.size + TABLE_ENTRY.size * count]
+        # Из таблицы в память копируются только id (для бинарного поиска)
+        self._ids = [entry[0] for entry in TABLE_ENTRY.iter_unpack(table)]
+        self._lock = threading.Lock()
+        # id -> latex (изменённая формула) или None (удалённая формула)
+        self._overlay = {}
+        self._overlay_prepared = {}
+        self._load_delta()
+
+    def _load_delta(self):
+        if not os.path.exists(delta_path(self.path)):
+            return
+        with open(delta_path(self.path), encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.apply_change(entry["op"], entry["id"], entry.get("latex"))
+
+    def apply_change(self, op, formula_id, latex_formula=None):
+        """Накладывает изменение каталога поверх снапшота (без записи в журнал)."""
+        with self._lock:
+            self._overlay_prepared.pop(formula_id, None)
+            if op == "delete":
+                self._overlay[formula_id] = None
+            elif op == "upsert":
+                self._overlay[formula_id] = latex_formula
+            else:
+                raise ValueError(f"Неизвестная операция журнала: {op}")
+
+    def _offset(self, formula_id):
+        position = bisect.bisect_left(self._ids, formula_id)
+        if position == len(self._ids) or self._ids[position] != formula_id:
+            return None
+        _, offset, _ = TABLE_ENTRY.unpack_from(self._mmap, HEADER.size + TABLE_ENTRY.size * position)
+        return offset
+
+    def _read(self, formula_id):
+        offset = self._offset(formula_id)
+        return decode_record(self._mmap, offset) if offset is not None else None
+
+    def get(self, formula_id, latex_formula=None):
+        """
+        Возвращает подготовленную формулу по id или None, если её нет.
+        Если передан latex_formula и он не совпадает с сохранённым,
+        запись считается устаревшей и тоже возвращается None.
+        """
+        if formula_id in self._overlay:
+            latex = self._overlay[formula_id]
+            if latex is None:
+                return None
+            prepared = self._overlay_prepared.get(formula_id)
+            if prepared is None:
+                prepared = prepare_formula(latex)
+                self._overlay_prepared[formula_id] = prepared
+        else:
+            prepared = self._read(formula_id)
+        if prepared is None or (latex_formula is not None and prepared.latex != latex_formula):
+            return None
+        return prepared
+
+    def get_fingerprint(self, formula_id, latex_formula=None):
+        """
+        Возвращает пару (число переменных, числовой отпечаток) формулы по id или None
+        по тем же правилам, что и get, но без декодирования канонических форм из снапшота.
+        """
+        if formula_id in self._overlay:
+            prepared = self.get(formula_id, latex_formula)
+            return (prepared.num_vars, prepared.fingerprint) if prepared is not None else None
+        offset = self._offset(formula_id)
+        if offset is None:
+            return None
+        latex, num_vars, fingerprint = decode_record_fingerprint(self._mmap, offset)
+        if latex_formula is not None and latex != latex_formula:
+            return None
+        return num_vars, fingerprint
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_snapshot_path():
+    """Путь к снапшоту из переменной окружения FORMULA_SNAPSHOT_PATH (или None)."""
+    return os.environ.get("FORMULA_SNAPSHOT_PATH") or None
+
+
+def get_snapshot_store():
+    """
+    Возвращает открытый снапшот процесса или None,
+    если снапшот не настроен или ещё не построен.
+    """
+    global _store
+    path = get_snapshot_path()
+    if not path:
+        return None
+    with _store_lock:
+        if _store is None and os.path.exists(path):
+            try:
+                _store = SnapshotStore(path)
+                logger.info(f"Снапшот {path} открыт: {_store.count} формул")
+            except (OSError, ValueError) as e:
+                logger.error(f"Не удалось открыть снапшот {path}: {e}")
+        return _store
+
+
+def record_change(op, formula_id, latex_formula=None):
+    """
+    Фиксирует изменение каталога в журнале снапшота и в снапшоте текущего процесса.
+    Ничего не делает, если снапшот не настроен.
+    """
+    path = get_snapshot_path()
+    if not path:
+        return
+    try:
+        append_delta(path, op, formula_id, latex_formula)
+        store = get_snapshot_store()
+        if store is not None:
+            store.apply_change(op, formula_id, latex_formula)
+    except (OSError, ValueError) as e:
+        logger.error(f"Не удалось записать изменение формулы ID {formula_id} в журнал снапшота: {e}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != "build":
+        print("Использование: python snapshot.py build <путь к снапшоту>")
+        sys.exit(1)
+
+    from db import SessionLocal, iter_formula_sources
+
+    db = SessionLocal()
+    try:
+        formulas = [(formula.id, formula.latex_formula) for formula in iter_formula_sources(db)]
+    finally:
+        db.close()
+    started = time.time()
+    written = write_snapshot(sys.argv[2], formulas)
+    print(f"Снапшот {sys.argv[2]} построен: {written} из {len(formulas)} формул за {time.time() - started:.1f} с")
@@ -0,0 +1,112 @@
+# streaming.py
+"""
+Потоковая выдача результатов поиска похожих формул.
+
+Сравнения выполняются по одному в пуле потоков, и по мере их завершения
+клиенту отправляются события:
+    match - найдена эквивалентная формула (отправляется сразу);
+    top_k - изменился текущий top-K;
+    done  - поиск завершён, содержит итоговый top-K;
+    error - поиск прерван ошибкой.
+Вероятные эквивалентные формулы сравниваются первыми (см. order_candidates),
+поэтому точные совпадения приходят раньше уточнений.
+Если клиент отключился, оставшиеся сравнения не выполняются.
+"""
+import asyncio
+import json
+import logging
+
+from index import prepare_formula
+from search import compare_latex, compare_with_formula, formula_to_dict, order_candidates, top_k, DEFAULT_TOP_K
+
+logger = logging.getLogger(__name__)
+
+SSE_MEDIA_TYPE = "text/event-stream"
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def format_ndjson(event, data):
+    return json.dumps({"event": event, **data}, ensure_ascii=False) + "\n"
+
+
+async def stream_similar(input_formula, load_formulas, executor, is_disconnected,
+                         k=DEFAULT_TOP_K, store=None, formatter=format_ndjson, load_rows=None):
+    """
+    Асинхронный генератор событий поиска похожих формул.
+    load_formulas - функция без аргументов, возвращающая формулы каталога (выполняется в executor);
+    is_disconnected - корутина-функция, сообщающая, что клиент отключился.
+    load_rows - функция, возвращающая по списку ID словарь {id: Formula} (выполняется в executor);
+    если она задана, load_formulas может возвращать пары (id, latex_formula), а полные строки
+    читаются только для формул, попадающих в события match и top_k.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        prepared_input = await loop.run_in_executor(executor, prepare_formula, input_formula)
+        formulas = await loop.run_in_executor(executor, load_formulas)
+        formulas = await loop.run_in_executor(executor, order_candidates, prepared_input, formulas, store)
+    except Exception as e:
+        logger.error(f"Ошибка при подготовке потокового поиска: {e}")
+        yield formatter("error", {"detail": f"Ошибка при поиске похожих формул: {e}"})
+        return
+
+    def compare_one(formula):
+        prepared = store.get(formula.id, formula.latex_formula) if store is not None else None
+        if load_rows is None:
+            return compare_with_formula(prepared_input, formula, prepared)
+        return {"formula": formula.id, **compare_latex(prepared_input, formula.latex_formula, prepared)}
+
+    # Полные строки формул, уже прочитанные для событий: {id: словарь FormulaResponse или None, если удалена}
+    rows = {}
+
+    def load_missing(ids):
+        loaded = load_rows(ids)
+        return {formula_id: formula_to_dict(loaded[formula_id]) if formula_id in loaded else None
+                for formula_id in ids}
+
+    async def with_rows(results):
+        """Подставляет полные строки формул в результаты; формулы, удалённые после чтения каталога, пропускаются."""
+        if load_rows is None:
+            return results
+        missing = [result["formula"] for result in results if result["formula"] not in rows]
+        if missing:
+            rows.update(await loop.run_in_executor(executor, load_missing, missing))
+        return [{**result, "formula": rows[result["formula"]]}
+                for result in results if rows[result["formula"]] is not None]
+
+    total = len(formulas)
+    current = []
+    for scanned, formula in enumerate(formulas, 1):
+        if await is_disconnected():
+            logger.info(f"Клиент отключился, поиск остановлен после {scanned - 1} из {total} формул")
+            return
+        try:
+            result = await loop.run_in_executor(executor, compare_one, formula)
+        except Exception as e:
+            logger.error(f"Ошибка при сравнении формул ID {formula.id}: {e}")
+            continue
+
+        try:
+            if result["equivalent"]:
+                for match in await with_rows([result]):
+                    yield formatter("match", {"result": match, "scanned": scanned, "total": total})
+            # Вытесненный из top-K результат туда уже не вернётся, поэтому храним только текущий top-K
+            best = top_k(current + [result], k)
+            if any(r is result for r in best):
+                current = best
+                yield formatter("top_k", {"results": await with_rows(current), "scanned": scanned, "total": total})
+        except Exception as e:
+            logger.error(f"Ошибка при чтении формул для потокового поиска: {e}")
+            yield formatter("error", {"detail": f"Ошибка при поиске похожих формул: {e}"})
+            return
+
+    try:
+        results = await with_rows(current)
+    except Exception as e:
+        logger.error(f"Ошибка при чтении формул для потокового поиска: {e}")
+        yield formatter("error", {"detail": f"Ошибка при поиске похожих формул: {e}"})
+        return
+    yield formatter("done", {"results": results, "scanned": total, "total": total})